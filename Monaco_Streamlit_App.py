@@ -1,11 +1,46 @@
+import os
+import time
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
 from montecarlo_simulation import Montecarlo, build_firm_attributes_for_simulation, stages, stage_probs, stage_valuations, stage_dilution
+from montecarlo_statistics import paired_difference, histogram_edges
+from montecarlo_cache import ResultCache, canonical_hash
+from montecarlo_jobs import JobRunner, SimulationJob
 
 st.title('Monaco: Monte Carlo Simulation for VC Returns')
 
-def run_single_simulation(params):
+## One cache per server process, shared by every session: finished simulations by Montecarlo.cache_key(), in memory and on disk
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(os.environ.get('MONACO_CACHE_DIR'))
+
+## One worker pool per server process: simulations run as background jobs so the page never waits on a whole run
+@st.cache_resource
+def get_job_runner():
+    return JobRunner()
+
+## Scenarios per job batch: partial results are published after every batch
+batch_size = 1000
+
+## One seed for the whole server (MONACO_SEED overrides it). Every session runs the same scenarios for the same parameters, so a run any session has
+## finished is a cache hit for all of them, and with common random numbers the current and previous runs see the same company fate draws, so their
+## difference is the effect of the parameter change rather than noise
+app_seed = int(os.environ.get('MONACO_SEED', 1729))
+
+## Both columns, and partial results, are binned on the server with the same edges, so only these bar heights are sent to the browser
+mom_edges = histogram_edges()
+
+def cache_result(key, montecarlo):
+    ## Only the SimulationResult is needed to display a run; drop the per-scenario arrays before caching
+    montecarlo.scenario_arrays = None
+    montecarlo.firm_scenarios = []
+    montecarlo.template_firm = None
+    get_result_cache().put(key, montecarlo)
+
+def run_single_simulation(params, seed):
+    ''' The finished Montecarlo if this configuration is cached, otherwise a SimulationJob running it in the background (cached when it completes)'''
     firm_attributes = build_firm_attributes_for_simulation(
         params['pre_seed_percentage'], params['pre_seed_investment'],
         params['seed_percentage'], params['seed_investment'],
@@ -13,11 +48,64 @@ def run_single_simulation(params):
         params['pro_rata_stage']
     )
     
-    montecarlo = Montecarlo(params['num_scenarios'], stages, stage_probs, stage_valuations, stage_dilution, firm_attributes)
-    montecarlo.initialize_scenarios()
-    montecarlo.simulate()
-    
-    return montecarlo
+    montecarlo = Montecarlo(params['num_scenarios'], stages, stage_probs, stage_valuations, stage_dilution, firm_attributes, engine='vectorized', seed=seed, common_random_numbers=True)
+
+    ## Jobs draw their random numbers batch by batch, so the batch size is part of what determines the outcomes
+    key = montecarlo.cache_key()
+    if key is not None:
+        key = canonical_hash(key, batch_size)
+    cached = get_result_cache().get(key)
+    if cached is not None:
+        return cached
+    return get_job_runner().submit(montecarlo, batch_size, on_complete=lambda finished: cache_result(key, finished))
+
+def display_progress(job, title):
+    st.subheader(title)
+
+    progress = job.snapshot()
+    st.progress(progress['Scenarios done']/progress['Scenarios'], text=f"{progress['Scenarios done']} of {progress['Scenarios']} scenarios")
+    if progress['Histogram'] is None:
+        return
+    plot_histogram(progress['Histogram'], 'Distribution of Multiple on Money (MoM), so far')
+
+    st.subheader('Performance Quartiles (running)')
+    for percentile, value in progress['Percentiles'].items():
+        st.write(f"{percentile}th Percentile: {value:.2f}x")
+
+def plot_histogram(histogram, title):
+    ''' Bar chart of a pre-binned Histogram, with anything past the last edge drawn as one more bar'''
+    widths = np.diff(histogram.edges)
+    centers = histogram.edges[:-1] + widths/2
+    fig = go.Figure(data=[go.Bar(x=centers, y=histogram.counts, width=widths, name='MoM'),
+                          go.Bar(x=[histogram.edges[-1] + widths[-1]/2], y=[histogram.overflow], width=[widths[-1]], name=f"{histogram.edges[-1]:g}x+")])
+    fig.update_layout(title=title,
+                      xaxis_title='Multiple on Money',
+                      yaxis_title='Frequency',
+                      showlegend=False,
+                      bargap=0)
+    st.plotly_chart(fig)
+
+def plot_percentile_bands(montecarlo):
+    ''' The middle 90% and 50% of MoM outcomes as nested bands, with the median marked'''
+    percentile = {p: montecarlo.result.percentile(p) for p in (5, 25, 50, 75, 95)}
+    fig = go.Figure(data=[go.Bar(y=['MoM'], x=[percentile[95] - percentile[5]], base=[percentile[5]], orientation='h', opacity=0.35, name='P5-P95'),
+                          go.Bar(y=['MoM'], x=[percentile[75] - percentile[25]], base=[percentile[25]], orientation='h', opacity=0.7, name='P25-P75'),
+                          go.Scatter(y=['MoM'], x=[percentile[50]], mode='markers', marker={'size': 14, 'symbol': 'line-ns-open'}, name='Median')])
+    fig.update_layout(title='Percentile bands', xaxis_title='Multiple on Money', barmode='overlay', height=220)
+    st.plotly_chart(fig)
+
+def display(item, title):
+    ''' Show a finished Montecarlo, or the latest partial results of a job; returns the finished Montecarlo or None'''
+    if isinstance(item, SimulationJob):
+        if not item.done():
+            display_progress(item, title)
+            return None
+        item = item.result()
+        if item is None:
+            st.write("Simulation cancelled")
+            return None
+    display_results(item, title)
+    return item
 
 def display_results(montecarlo, title):
     st.subheader(title)
@@ -29,12 +117,9 @@ def display_results(montecarlo, title):
     st.write(f"Follow-on Reserve: ${overview['Follow on']} million")
     st.write(f"Median MoM: {overview['Median MoM']:.2f}x")
     
-    outcomes = montecarlo.get_MoM_return_outcomes()
-    fig = go.Figure(data=[go.Histogram(x=outcomes, nbinsx=50)])
-    fig.update_layout(title='Distribution of Multiple on Money (MoM)',
-                      xaxis_title='Multiple on Money',
-                      yaxis_title='Frequency')
-    st.plotly_chart(fig)
+    plot_histogram(montecarlo.montecarlo_histogram(mom_edges), 'Distribution of Multiple on Money (MoM)')
+    if show_percentile_bands:
+        plot_percentile_bands(montecarlo)
     
     quartiles = montecarlo.performance_quartiles()
     st.subheader('Performance Quartiles')
@@ -56,6 +141,7 @@ follow_on_percentage = st.sidebar.slider('Follow-on Reserve (%)', 0, 100, 30) /
 params['primary'] = params['fund_size'] * (1 - follow_on_percentage)
 params['follow_on'] = params['fund_size'] * follow_on_percentage
 params['pro_rata_stage'] = st.sidebar.selectbox('Pro-rata Up To', options=stages, index=2)  # Default to Series A
+show_percentile_bands = st.sidebar.checkbox('Show percentile bands', value=False)
 
 if 'previous_params' not in st.session_state:
     st.session_state.previous_params = None
@@ -63,22 +149,50 @@ if 'previous_params' not in st.session_state:
 if 'current_results' not in st.session_state:
     st.session_state.current_results = None
 
+## Jobs started by this session for running_params; changing any parameter cancels them
+if 'running_jobs' not in st.session_state:
+    st.session_state.running_jobs = []
+    st.session_state.running_params = None
+
+if st.session_state.running_params != params:
+    for job in st.session_state.running_jobs:
+        job.cancel()
+    st.session_state.running_jobs = []
+
 if st.sidebar.button('Run Simulation'):
-    current_results = run_single_simulation(params)
+    current = run_single_simulation(params, app_seed)
+    previous = None
+    if st.session_state.previous_params is not None:
+        previous = run_single_simulation(st.session_state.previous_params, app_seed)
+    st.session_state.running_jobs = [item for item in (current, previous) if isinstance(item, SimulationJob)]
+    st.session_state.running_params = params.copy()
+    st.session_state.previous_params = params.copy()
     
     col1, col2 = st.columns(2)
-    
     with col1:
-        display_results(current_results, "Current Simulation")
-    
+        current_placeholder = st.empty()
     with col2:
-        if st.session_state.previous_params is not None:
-            previous_results = run_single_simulation(st.session_state.previous_params)
-            display_results(previous_results, "Previous Simulation")
-        else:
-            st.write("No previous simulation available")
+        previous_placeholder = st.empty()
+
+    ## Redraw the partial results until both runs are done; a rerun (e.g. a parameter change) interrupts this loop and the jobs are cancelled above
+    while True:
+        finished = all(job.done() for job in st.session_state.running_jobs)
+        with current_placeholder.container():
+            current_results = display(current, "Current Simulation")
+        with previous_placeholder.container():
+            previous_results = None
+            if previous is not None:
+                previous_results = display(previous, "Previous Simulation")
+            else:
+                st.write("No previous simulation available")
+        if finished:
+            break
+        time.sleep(0.25)
+
+    if current_results is not None and previous_results is not None:
+        difference = paired_difference(previous_results.result, current_results.result)
+        st.write(f"Change in mean MoM vs. previous: {difference['Mean difference']:+.2f}x ± {difference['Standard error']:.2f}x")
     
-    st.session_state.previous_params = params.copy()
     st.session_state.current_results = current_results
 
 # Instructions
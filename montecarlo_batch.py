@@ -0,0 +1,198 @@
+''' Headless batch runs: simulate every fund configuration in a JSON or YAML file on a process pool and write one summary row per configuration.
+
+    python montecarlo_batch.py configs.yaml --output results.csv --scenario-budget 2000000
+
+The file holds a list of configurations, or a mapping with:
+    configs   list of configurations: build_firm_attributes_for_simulation arguments by name (pre_seed_percentage, pre_seed_investment_amount,
+              seed_percentage, seed_investment_amount, primary, follow_on, total_fund_size, pro_rata_at_or_below), plus optional name, num_scenarios,
+              firm_lifespan_periods, firm_lifespan_years and market
+    defaults  values every configuration starts from; seed_percentage and follow_on default to the rest of the pre-seed share and of the fund
+    market    overrides of the market tables (stages, stage_probs, stage_valuations, stage_dilution), merged key by key into the built-in ones;
+              a configuration's own market is merged on top
+
+Every configuration is split into shards that run on all cores, and its row is written to the output (CSV, or Parquet for a .parquet path)
+as soon as its last shard finishes. Every row records the root seed, so any row can be reproduced from the file alone; a configuration
+that is missing fields or has invalid ones gets a row with an Error instead.'''
+import os
+import sys
+import json
+import math
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import montecarlo_simulation as simulation
+from montecarlo_simulation import simulate_shard, build_firm_attributes_for_simulation
+from montecarlo_statistics import SimulationResult
+
+
+## build_firm_attributes_for_simulation arguments every configuration needs, from itself or the defaults
+required_fields = ('pre_seed_percentage', 'pre_seed_investment_amount', 'seed_percentage', 'seed_investment_amount',
+                   'primary', 'follow_on', 'total_fund_size', 'pro_rata_at_or_below')
+
+
+def load_configs(path):
+    ''' Read a JSON or YAML (needs PyYAML) batch file and return (configs, market overrides, defaults)'''
+    with open(path) as config_file:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            batch = yaml.safe_load(config_file)
+        else:
+            batch = json.load(config_file)
+    if isinstance(batch, list):
+        batch = {'configs': batch}
+    return batch['configs'], batch.get('market', {}), batch.get('defaults', {})
+
+
+def merge_market(*overrides):
+    ''' The built-in market tables with each set of overrides merged in, table by table'''
+    market = {'stages': list(simulation.stages), 'stage_probs': dict(simulation.stage_probs),
+              'stage_valuations': dict(simulation.stage_valuations), 'stage_dilution': dict(simulation.stage_dilution)}
+    for override in overrides:
+        for table, values in (override or {}).items():
+            if table not in market:
+                raise ValueError('Unknown market table: ' + str(table))
+            market[table] = list(values) if table == 'stages' else {**market[table], **values}
+    return market
+
+
+def complete_config(defaults, overrides):
+    ''' A configuration merged over the defaults, like complete_sweep_point. The seed share and the reserve are derived from the merged values
+    (the rest of the pre-seed share and of the fund) when the configuration changes what they depend on without setting them, or when neither sets them.
+    Fields that can't be derived are left out, for run_batch to report.'''
+    config = {**defaults, **overrides}
+    if ('pre_seed_percentage' in overrides or 'seed_percentage' not in config) and 'seed_percentage' not in overrides and 'pre_seed_percentage' in config:
+        config['seed_percentage'] = 1 - config['pre_seed_percentage']
+    if (('primary' in overrides or 'total_fund_size' in overrides) or 'follow_on' not in config) and 'follow_on' not in overrides \
+            and 'primary' in config and 'total_fund_size' in config:
+        config['follow_on'] = config['total_fund_size'] - config['primary']
+    return config
+
+
+def build_config_attributes(config, market):
+    ''' firm_attributes for a configuration, valued with its own market tables. Raises ValueError saying what is wrong with an invalid one.'''
+    if config['pro_rata_at_or_below'] not in market['stage_valuations']:
+        raise ValueError('pro_rata_at_or_below stage ' + str(config['pro_rata_at_or_below']) + ' has no valuation in the market')
+    for stage, share in (('Pre-seed', config['pre_seed_percentage']), ('Seed', config['seed_percentage'])):
+        if share > 0 and (stage not in market['stages'] or stage not in market['stage_valuations']):
+            raise ValueError(stage + ' checks are made but the market has no ' + stage + ' stage')
+    if config['pre_seed_percentage'] + config['seed_percentage'] != 1:
+        raise ValueError('pre_seed_percentage + seed_percentage is not 1')
+    if config['primary'] + config['follow_on'] != config['total_fund_size']:
+        raise ValueError('primary + follow_on is not total_fund_size')
+    firm_attributes = build_firm_attributes_for_simulation(config['pre_seed_percentage'], config['pre_seed_investment_amount'],
+                                                           config['seed_percentage'], config['seed_investment_amount'],
+                                                           config['primary'], config['follow_on'], config['total_fund_size'],
+                                                           config['pro_rata_at_or_below'], market['stage_valuations'])
+    if firm_attributes is None:
+        raise ValueError('primary checks and reserve do not add up to total_fund_size')
+    firm_attributes['firm_lifespan_periods'] = config.get('firm_lifespan_periods', len(market['stages']) - 1)
+    firm_attributes['firm_lifespan_years'] = config.get('firm_lifespan_years', simulation.lifespan_years)
+    return firm_attributes
+
+
+def allocate_budget(requested, budget):
+    ''' Scenarios per configuration: what each asked for, scaled down proportionally (at least 1 each) if the total exceeds budget'''
+    total = sum(requested)
+    if budget is None or total <= budget:
+        return list(requested)
+    return [max(1, int(math.floor(num_scenarios*budget/total))) for num_scenarios in requested]
+
+
+def simulate_batch_shard(num_scenarios, market, firm_attributes, engine, seed):
+    ''' Run one shard of a configuration in a worker process and return just its per-scenario outcomes'''
+    arrays = simulate_shard(num_scenarios, market['stages'], market['stage_probs'], market['stage_valuations'], market['stage_dilution'],
+                            firm_attributes, engine, seed, common_random_numbers=(engine == 'vectorized'))
+    num_periods = firm_attributes['firm_lifespan_periods']
+    years = np.arange(num_periods + 1)*firm_attributes['firm_lifespan_years']/num_periods
+    return SimulationResult.from_scenario_arrays(arrays, years).outcomes
+
+
+def summary_row(index, config, outcomes, seed):
+    ''' One output row: the configuration, the root seed that reproduces it, and its outcome statistics'''
+    result = SimulationResult(*(np.concatenate([shard[type] for shard in outcomes]) for type in ('MoM', 'Value', 'Invested', 'Alive', 'Acquired', 'IRR')))
+    row = {'Config': index, 'Name': config.get('name', str(index)), 'Seed': str(seed), **{key: value for key, value in config.items() if key not in ('name', 'market')}}
+    row.update(result.summary())
+    for p in [25, 50, 75]:
+        row[f'P{p} IRR'] = result.percentile(p, 'IRR')
+    return row
+
+
+def write_rows(rows, output):
+    ''' Write every finished row so far: CSV by default, Parquet (needs pyarrow) for a .parquet path. The file is replaced atomically.'''
+    table = pd.DataFrame(rows)
+    temporary_path = output + '.tmp'
+    if output.endswith('.parquet'):
+        table.to_parquet(temporary_path, index=False)
+    else:
+        table.to_csv(temporary_path, index=False)
+    os.replace(temporary_path, output)
+
+
+def run_batch(configs, output, market=None, defaults=None, scenario_budget=None, num_scenarios=simulation.num_scenarios,
+              seed=None, engine='vectorized', max_workers=None, shard_size=10000):
+    ''' Simulate every configuration and return their summary rows, in the order they finished. Every configuration draws from the same seed,
+    with common random numbers on the vectorized engine, so differences between rows reflect the configurations rather than sampling noise.'''
+    seed = np.random.SeedSequence().entropy if seed is None else seed
+    configs = [complete_config(defaults or {}, config) for config in configs]
+    budget = allocate_budget([config.get('num_scenarios', num_scenarios) for config in configs], scenario_budget)
+
+    rows = []
+    pending = {}
+    outcomes = {}
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        futures = {}
+        for index, (config, config_scenarios) in enumerate(zip(configs, budget)):
+            missing = [field for field in required_fields if field not in config]
+            if missing:
+                rows.append({'Config': index, 'Name': config.get('name', str(index)), 'Seed': str(seed), 'Error': 'missing ' + ', '.join(missing)})
+                write_rows(rows, output)
+                continue
+            try:
+                config_market = merge_market(market, config.get('market'))
+                firm_attributes = build_config_attributes(config, config_market)
+            except ValueError as error:
+                rows.append({'Config': index, 'Name': config.get('name', str(index)), 'Seed': str(seed), 'Error': str(error)})
+                write_rows(rows, output)
+                continue
+
+            ## Shard i of every configuration draws from the i-th child of the seed
+            shard_sizes = [min(shard_size, config_scenarios - start) for start in range(0, config_scenarios, shard_size)]
+            shard_seeds = np.random.SeedSequence(seed).spawn(len(shard_sizes))
+            pending[index] = len(shard_sizes)
+            outcomes[index] = [None]*len(shard_sizes)
+            for shard, (size, shard_seed) in enumerate(zip(shard_sizes, shard_seeds)):
+                futures[executor.submit(simulate_batch_shard, size, config_market, firm_attributes, engine, shard_seed)] = (index, shard)
+
+        for future in as_completed(futures):
+            index, shard = futures[future]
+            outcomes[index][shard] = future.result()
+            pending[index] -= 1
+            if pending[index] == 0:
+                rows.append(summary_row(index, configs[index], outcomes.pop(index), seed))
+                write_rows(rows, output)
+                print(f"Finished {rows[-1]['Name']} ({len(rows)} of {len(configs)})", file=sys.stderr)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate a batch of fund configurations and write one summary row per configuration')
+    parser.add_argument('configs', help='JSON or YAML file of configurations')
+    parser.add_argument('--output', default='montecarlo_results.csv', help='CSV file, or a .parquet file (needs pyarrow)')
+    parser.add_argument('--scenarios', type=int, default=simulation.num_scenarios, help='scenarios per configuration that does not set num_scenarios')
+    parser.add_argument('--scenario-budget', type=int, default=None, help='cap on the total scenarios across all configurations')
+    parser.add_argument('--seed', type=int, default=None, help='root seed (fresh entropy if not given), written to every row\'s Seed column')
+    parser.add_argument('--engine', choices=['vectorized', 'object'], default='vectorized')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: every core)')
+    parser.add_argument('--shard-size', type=int, default=10000, help='scenarios per task')
+    args = parser.parse_args(argv)
+
+    configs, market, defaults = load_configs(args.configs)
+    seed = np.random.SeedSequence().entropy if args.seed is None else args.seed
+    print(f"Running {len(configs)} configurations with seed {seed}", file=sys.stderr)
+    rows = run_batch(configs, args.output, market, defaults, args.scenario_budget, args.scenarios, seed, args.engine, args.workers, args.shard_size)
+    print(f"Wrote {len(rows)} rows to {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
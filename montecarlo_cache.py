@@ -0,0 +1,142 @@
+import os
+import json
+import pickle
+import hashlib
+import stat
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def canonical_hash(*parts):
+    ''' SHA-256 of a canonical JSON encoding of parts: dict keys sorted, tuples and arrays as lists, numpy scalars as Python numbers.
+    Equal configurations hash the same no matter how they were built.'''
+    def encode(value):
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, np.random.SeedSequence):
+            return {'entropy': value.entropy, 'spawn_key': list(value.spawn_key)}
+        raise TypeError('Cannot hash ' + type(value).__name__)
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=encode).encode()).hexdigest()
+
+
+#############################################################################
+#############################################################################
+########################### RESULT CACHE CLASS ##############################
+#############################################################################
+#############################################################################
+def private_directory(path):
+    ''' Create path readable and writable by the current user only, or check that an existing one is. Cache entries are unpickled,
+    so a directory anyone else can write to would let them run code in this process.'''
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):
+        status = os.stat(path)
+        if status.st_uid != os.getuid():
+            raise PermissionError('Cache directory ' + path + ' belongs to another user')
+        if stat.S_IMODE(status.st_mode) & 0o077:
+            os.chmod(path, 0o700)
+    return path
+
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'monaco')
+
+
+class ResultCache:
+    ''' Two-tier cache of finished simulations keyed by canonical_hash: up to max_memory_entries in memory and up to max_disk_bytes of pickles in cache_dir,
+    each evicting the least recently used entry first. A disk hit is promoted back into memory. Safe to share between threads (e.g. Streamlit sessions).
+    cache_dir defaults to ~/.cache/monaco and is kept private to the current user. A key of None (see Montecarlo.cache_key) is never cached.'''
+
+    def __init__(self, cache_dir=None, max_memory_entries=32, max_disk_bytes=512*2**20):
+        self.cache_dir = private_directory(cache_dir or default_cache_dir())
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = {'memory': 0, 'disk': 0, 'miss': 0}
+
+    def disk_path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits['memory'] += 1
+                return self.memory[key]
+
+        path = self.disk_path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                value = pickle.load(cache_file)
+        except Exception:
+            ## Unreadable, truncated, or pickled by an older version of the code (a class or module that has since moved raises
+            ## AttributeError / ModuleNotFoundError): all count as a miss, and the next put() overwrites the entry
+            with self.lock:
+                self.hits['miss'] += 1
+            return None
+
+        ## Touch the file so disk eviction sees it as recently used
+        os.utime(path)
+        with self.lock:
+            self.hits['disk'] += 1
+            self.remember(key, value)
+        return value
+
+    def put(self, key, value):
+        if key is None:
+            return
+        with self.lock:
+            self.remember(key, value)
+
+        ## Write to a temporary file and rename it into place, so readers never see a partial pickle
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(file_descriptor, 'wb') as cache_file:
+            pickle.dump(value, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, self.disk_path(key))
+        self.evict_disk()
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def remember(self, key, value):
+        ## Caller holds self.lock
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def evict_disk(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total_size = sum(size for modified, size, name in entries)
+        for modified, size, name in sorted(entries):
+            if total_size <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl'):
+                os.remove(os.path.join(self.cache_dir, name))
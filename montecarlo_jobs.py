@@ -0,0 +1,111 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from montecarlo_simulation import ScenarioArrays
+from montecarlo_statistics import OutcomeAccumulator, SimulationResult, Histogram
+
+
+#############################################################################
+#############################################################################
+########################## SIMULATION JOB CLASS #############################
+#############################################################################
+#############################################################################
+class SimulationJob:
+    ''' A vectorized Montecarlo run done batch_size scenarios at a time on a background thread. After every batch the job publishes
+    partial aggregates (MoM histogram and running percentiles, see snapshot()), and it checks for cancellation between batches.
+    When it finishes, montecarlo.result holds every scenario as if simulate() had been called with batched draws.'''
+
+    percentiles = (25, 50, 75, 90, 95)
+
+    def __init__(self, montecarlo, batch_size=1000, on_complete=None):
+        if montecarlo.engine != 'vectorized':
+            raise ValueError('Background jobs run the vectorized engine')
+        self.montecarlo = montecarlo
+        self.batch_size = batch_size
+        self.on_complete = on_complete
+        self.status = 'pending'
+        self.error = None
+        self.future = None
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.progress = {'Scenarios done': 0, 'Scenarios': montecarlo.num_scenarios, 'Histogram': None, 'Percentiles': {}}
+
+    def run(self):
+        montecarlo = self.montecarlo
+        self.status = 'running'
+        try:
+            generator = montecarlo.generator()
+            accumulator = OutcomeAccumulator()
+            batches = []
+            for batch, start in enumerate(range(0, montecarlo.num_scenarios, self.batch_size)):
+                if self.cancelled.is_set():
+                    self.status = 'cancelled'
+                    return None
+                arrays = montecarlo.build_scenario_arrays(min(self.batch_size, montecarlo.num_scenarios - start))
+                montecarlo.simulate_vectorized(arrays, montecarlo.random_draws(generator, (batch,), start))
+                batches.append(arrays)
+                accumulator.update(arrays.get_MoM())
+                self.publish(start + len(arrays), accumulator)
+
+            montecarlo.scenario_arrays = ScenarioArrays.concatenate(batches)
+            montecarlo.result = SimulationResult.from_scenario_arrays(montecarlo.scenario_arrays, montecarlo.cash_flow_years())
+        except Exception as error:
+            self.error = error
+            self.status = 'failed'
+            raise
+        self.status = 'done'
+        if self.on_complete is not None:
+            self.on_complete(montecarlo)
+        return montecarlo
+
+    def publish(self, scenarios_done, accumulator):
+        ## Copy the histogram so readers never see it while the next batch is being added
+        histogram = Histogram(accumulator.histogram.edges)
+        histogram.merge(accumulator.histogram)
+        progress = {
+            'Scenarios done': scenarios_done,
+            'Scenarios': self.montecarlo.num_scenarios,
+            'Histogram': histogram,
+            'Percentiles': {p: accumulator.percentile(p) for p in self.percentiles}
+        }
+        with self.lock:
+            self.progress = progress
+
+    def snapshot(self):
+        ''' Latest partial aggregates: scenarios done out of the total, the MoM Histogram so far and its running percentiles'''
+        with self.lock:
+            return dict(self.progress)
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def done(self):
+        return self.status in ('done', 'cancelled', 'failed') or (self.future is not None and self.future.cancelled())
+
+    def result(self, timeout=None):
+        ''' The finished Montecarlo (None if cancelled), waiting up to timeout seconds'''
+        if self.future.cancelled():
+            return None
+        return self.future.result(timeout)
+
+
+#############################################################################
+#############################################################################
+############################ JOB RUNNER CLASS ###############################
+#############################################################################
+#############################################################################
+class JobRunner:
+    ''' Shared worker pool for SimulationJobs. Threads are enough: the batches spend their time in NumPy, and the jobs have to share progress with the caller.'''
+
+    def __init__(self, max_workers=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count())
+
+    def submit(self, montecarlo, batch_size=1000, on_complete=None):
+        job = SimulationJob(montecarlo, batch_size, on_complete)
+        job.future = self.executor.submit(job.run)
+        return job
+
+    def shutdown(self, cancel_jobs=True):
+        self.executor.shutdown(wait=False, cancel_futures=cancel_jobs)
@@ -1,35 +1,242 @@
 import random
+import bisect
 import math
 import numpy as np
-import time
+import os
+import itertools
+from statistics import NormalDist
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+from montecarlo_store import ResultStore
+from montecarlo_cache import canonical_hash
+from montecarlo_statistics import OutcomeAccumulator, SimulationResult, DistributionResult, Histogram, histogram_edges, internal_rate_of_return, quantile_confidence_interval, control_variate_estimate, lattice_distribution, common_step
+
+
+## Integer codes for company state (index into state_names)
+ALIVE = 0
+FAILED = 1
+ACQUIRED = 2
+state_names = ['Alive', 'Failed', 'Acquired']
+
+## Bump whenever a change to the simulation logic changes its outcomes, so cached results from older code are not reused
+ENGINE_VERSION = 2
+
+## M&A outcomes - 1% chance of 10x outcome, 2% chance of 5x outcome, 27% chance of 1x outcome, 70% chance of 0.5x outcome
+m_and_a_outcome_odds = [0.01, 0.02, 0.27, 0.7]
+m_and_a_multipliers = [10, 5, 1, .5]
+
+
+#############################################################################
+#############################################################################
+######################## EXIT MULTIPLE CLASSES ##############################
+#############################################################################
+#############################################################################
+class ExitMultiples:
+    ''' Discrete table of M&A exit multiples: an acquisition multiplies the company's valuation by multipliers[i] with probability odds[i].
+    sample() maps a batch of uniform draws to multiples by inverse CDF, one searchsorted over the cumulative odds.'''
+
+    discrete = True
+
+    def __init__(self, multipliers=m_and_a_multipliers, odds=m_and_a_outcome_odds):
+        if len(multipliers) != len(odds) or not math.isclose(sum(odds), 1):
+            raise ValueError('Exit multiples need one probability per multiplier, summing to 1')
+        self.multipliers = np.array(multipliers, dtype=np.float64)
+        self.odds = np.array(odds, dtype=np.float64)
+        self.cumulative_odds = np.cumsum(self.odds)
+
+        ## The object engine draws one exit at a time, which is much faster with bisect on plain tuples than through NumPy
+        self.multipliers_tuple = tuple(self.multipliers.tolist())
+        self.cumulative_odds_tuple = tuple(self.cumulative_odds.tolist())
+
+    def sample(self, uniforms):
+        outcome = np.searchsorted(self.cumulative_odds, uniforms, side='right')
+        return self.multipliers[np.minimum(outcome, len(self.multipliers)-1)]
+
+    def sample_one(self, uniform):
+        return self.multipliers_tuple[min(bisect.bisect_right(self.cumulative_odds_tuple, uniform), len(self.multipliers_tuple)-1)]
+
+    def table(self):
+        ''' (multipliers, odds) of every outcome'''
+        return self.multipliers, self.odds
+
+    def mean(self):
+        return float(np.dot(self.multipliers, self.odds))
+
+    def params(self):
+        return {'type': 'table', 'multipliers': self.multipliers, 'odds': self.odds}
+
+
+class LognormalExitMultiples:
+    ''' Continuous exit multiples: median*exp(sigma*Z) for a standard normal Z. The normal inverse CDF is tabulated once on a fine grid,
+    so sample() is a single interpolated lookup (a searchsorted) over the whole batch.'''
+
+    discrete = False
+
+    def __init__(self, median=.5, sigma=1.2, grid_points=4097, grid_range=8):
+        self.median = median
+        self.sigma = sigma
+        self.z_grid = np.linspace(-grid_range, grid_range, grid_points)
+        self.cdf_grid = np.array([NormalDist().cdf(z) for z in self.z_grid])
+
+    def sample(self, uniforms):
+        return self.median*np.exp(self.sigma*np.interp(uniforms, self.cdf_grid, self.z_grid))
+
+    def sample_one(self, uniform):
+        return self.median*math.exp(self.sigma*NormalDist().inv_cdf(min(max(uniform, self.cdf_grid[0]), self.cdf_grid[-1])))
+
+    def table(self):
+        ''' A single outcome at the mean multiple: enough for expected values, not for the exact distribution'''
+        return np.array([self.mean()]), np.array([1.0])
+
+    def mean(self):
+        return self.median*math.exp(self.sigma**2/2)
+
+    def params(self):
+        return {'type': 'lognormal', 'median': self.median, 'sigma': self.sigma, 'grid_points': len(self.z_grid), 'grid_range': float(self.z_grid[-1])}
+
+
+class PowerLawExitMultiples:
+    ''' Continuous power-law (Pareto) exit multiples: at least minimum, with P(multiple > x) = (minimum/x)**alpha, capped at maximum if given.
+    The inverse CDF has a closed form, so sample() is a single vectorized expression.'''
+
+    discrete = False
+
+    def __init__(self, minimum=.25, alpha=1.1, maximum=None):
+        self.minimum = minimum
+        self.alpha = alpha
+        self.maximum = maximum
+
+    def sample(self, uniforms):
+        multiples = self.minimum*(1 - np.asarray(uniforms))**(-1/self.alpha)
+        return multiples if self.maximum is None else np.minimum(multiples, self.maximum)
+
+    def sample_one(self, uniform):
+        multiple = self.minimum*(1 - uniform)**(-1/self.alpha)
+        return multiple if self.maximum is None else min(multiple, self.maximum)
+
+    def table(self):
+        ''' A single outcome at the mean multiple: enough for expected values, not for the exact distribution'''
+        return np.array([self.mean()]), np.array([1.0])
+
+    def mean(self):
+        if self.maximum is None:
+            return self.minimum*self.alpha/(self.alpha - 1) if self.alpha > 1 else math.inf
+        tail = (self.minimum/self.maximum)**self.alpha
+        if self.alpha == 1:
+            return self.minimum*(1 + math.log(self.maximum/self.minimum))
+        return self.minimum*self.alpha/(self.alpha - 1)*(1 - tail*self.maximum/self.minimum) + self.maximum*tail
+
+    def params(self):
+        return {'type': 'power_law', 'minimum': self.minimum, 'alpha': self.alpha, 'maximum': self.maximum}
+
+
+#############################################################################
+#############################################################################
+######################### MARKET MODEL CLASS ################################
+#############################################################################
+#############################################################################
+class MarketModel:
+    ''' Stage probabilities, valuations and dilution compiled once into flat tables indexed by integer stage id (the stage's position in stages).
+    A single MarketModel is shared by every Company in a simulation instead of each company holding its own copy of the market tables.'''
+
+    def __init__(self, stages, stage_probs, stage_valuations, stage_dilution, exit_multiples=None):
+        self.stages = list(stages)
+        self.stage_ids = {stage: stage_id for stage_id, stage in enumerate(self.stages)}
+        self.last_stage = len(self.stages) - 1
+
+        ## Plain tuples for the per-company object engine
+        self.valuations = tuple(stage_valuations[stage] for stage in self.stages)
+        self.dilution = tuple(stage_dilution.get(stage, 0) for stage in self.stages)
+
+        ## Probabilities in order of [next round, fail, M&A]; a single draw below m_and_a_threshold is an M&A, below fail_threshold is a failure, otherwise a promotion
+        self.m_and_a_threshold = tuple(stage_probs[stage][2] for stage in self.stages)
+        self.fail_threshold = tuple(stage_probs[stage][2] + stage_probs[stage][1] for stage in self.stages)
+
+        ## The same tables as NumPy arrays for the vectorized engine
+        self.valuation_array = np.array(self.valuations, dtype=np.float64)
+        self.dilution_array = np.array(self.dilution, dtype=np.float64)
+        self.m_and_a_threshold_array = np.array(self.m_and_a_threshold)
+        self.fail_threshold_array = np.array(self.fail_threshold)
+
+        ## Distribution of the multiple applied to a company's valuation when it is acquired (ExitMultiples, LognormalExitMultiples or PowerLawExitMultiples)
+        self.exit_multiples = ExitMultiples() if exit_multiples is None else exit_multiples
+
+        ## Share of a stake left after diluting through every round up to and including each stage, if the firm never follows on
+        self.cumulative_retention = np.cumprod(1 - self.dilution_array)
+
+    def diluted_ownership(self, stage_id, ownership):
+        ''' Ownership at every stage for a stake of ownership taken at stage_id that never follows on (only meaningful from stage_id up)'''
+        return ownership*self.cumulative_retention/self.cumulative_retention[stage_id]
+
+    def terminal_outcomes(self, stage_id, ownership, num_periods, pro_rata_at_or_below=-math.inf):
+        ''' Every way a stake of ownership taken at stage_id can end after num_periods, as parallel arrays of (probability, firm value, follow-on invested).
+        The company's fate is a Markov chain over stages: each period an alive company below the last stage exits by M&A, fails or promotes, so a path
+        is fixed by when and how it exits. Pro rata is taken on every promotion to a valuation at or below pro_rata_at_or_below, assuming the reserve never runs out;
+        a full pro rata keeps ownership unchanged, otherwise the stake dilutes. A continuous exit distribution enters as its mean multiple.'''
+        m_and_a_multipliers, m_and_a_odds = self.exit_multiples.table()
+        probability, value, follow_on = [], [], []
+        alive = 1.0
+        invested = 0.0
+        for period in range(num_periods):
+            if stage_id == self.last_stage:
+                break
+            stake_value = self.valuations[stage_id]*ownership
+            probability += list(alive*self.m_and_a_threshold[stage_id]*m_and_a_odds) + [alive*(self.fail_threshold[stage_id] - self.m_and_a_threshold[stage_id])]
+            value += list(stake_value*m_and_a_multipliers) + [0.0]
+            follow_on += [invested]*(len(m_and_a_odds) + 1)
+
+            alive *= 1 - self.fail_threshold[stage_id]
+            stage_id += 1
+            if self.valuations[stage_id] <= pro_rata_at_or_below:
+                invested += ownership*self.dilution[stage_id]*self.valuations[stage_id]
+            else:
+                ownership *= 1 - self.dilution[stage_id]
+        probability.append(alive)
+        value.append(self.valuations[stage_id]*ownership)
+        follow_on.append(invested)
+        return np.array(probability), np.array(value), np.array(follow_on)
+
+    def expected_terminal_value(self, stage_id, ownership, num_periods):
+        ''' Exact expected firm value, after num_periods, of a stake of ownership taken at stage_id that never follows on'''
+        probability, value, follow_on = self.terminal_outcomes(stage_id, ownership, num_periods)
+        return float(np.dot(probability, value))
 
 
 class Company:
     
-    def __init__(self, name, stage, valuation, state, firm_invested_capital, firm_ownership, stages, valuations, dilution):
+    ## Slots keep each company to a handful of fields; stage and state are stored as integer codes
+    __slots__ = ('name', 'stage_id', 'valuation', 'state_code', 'firm_invested_capital', 'firm_ownership', 'market', 'exit_period')
+
+    def __init__(self, name, stage, valuation, state, firm_invested_capital, firm_ownership, market):
         self.name = name
-        self.stage = stage
+        self.stage_id = market.stage_ids[stage]
         self.valuation = valuation
-        self.state = state
+        self.state_code = state_names.index(state)
         self.firm_invested_capital = firm_invested_capital
         self.firm_ownership = firm_ownership
-        self.market_constraints = {
-            'stages': stages,
-            'valuations': valuations,
-            'dilution': dilution
-        }
-        self.age = 0
+        self.market = market
+
+        ## Period in which the company was acquired or failed (-1 while alive)
+        self.exit_period = -1
+
+    @property
+    def stage(self):
+        return self.market.stages[self.stage_id]
+
+    @property
+    def state(self):
+        return state_names[self.state_code]
     
     ## Promote this company to the next stage in its life
     def promote(self, secondary_dry_powder, pro_rata_at_or_below):
         
         ## Promote to the next stage and update states accordingly
-        self.age += 1
-        self.stage = self.market_constraints['stages'][min(self.market_constraints['stages'].index(self.stage) + 1, len(self.market_constraints['stages'])-1)] ## if already at last stage, stay at last stage
-        self.valuation = self.market_constraints['valuations'][self.stage]
+        self.stage_id = min(self.stage_id + 1, self.market.last_stage) ## if already at last stage, stay at last stage
+        self.valuation = self.market.valuations[self.stage_id]
 
         ## Determine post-dilution ownership
-        dilution = self.market_constraints['dilution'][self.stage]
+        dilution = self.market.dilution[self.stage_id]
         post_dilution_ownership = self.firm_ownership*(1-dilution)
         
         ## If the fund does pro rata at this stage, and still has dry powder to contribute to secondaries, then determine pro rata investment
@@ -45,49 +252,43 @@ class Company:
         return pro_rata_investment
             
 
-    ## execute M&A for this company
-    def m_and_a(self):
+    ## execute M&A for this company in period, drawing the exit outcome from rng (anything with a random() method)
+    def m_and_a(self, rng, period):
 
-        ## Increment age and adjust stage
-        self.age += 1
-        self.state = "Acquired"
+        ## Record the exit and adjust state
+        self.exit_period = period
+        self.state_code = ACQUIRED
 
-        ## M&A outcomes - todo: move these to global or montecarlo class
-        ## 1% chance of 10x outcome, 2% chance of 5x outcome, 27% chance of 1x outcome, 70% chance of 0.5x outcome
-        m_and_a_outcome_odds = [0.01, 0.02, 0.27, 0.7]
-        m_and_a_multipliers = [10,5,1,.5]
-
-        
         ## Generate random value which determines M&A outcomes
-        rand = random.random()
-        if rand <m_and_a_outcome_odds[0]:
-            # print('10x')
-            self.valuation = m_and_a_multipliers[0]*self.valuation
-        elif rand < m_and_a_outcome_odds[0]+m_and_a_outcome_odds[1]:
-            # print('5x')
-            self.valuation = m_and_a_multipliers[1]*self.valuation
-        elif rand < m_and_a_outcome_odds[0]+m_and_a_outcome_odds[1]+m_and_a_outcome_odds[2]:
-            # print('1x')
-            self.valuation = m_and_a_multipliers[2]*self.valuation
-        else:
-            # print('0.5x')
-            self.valuation = m_and_a_multipliers[3]*self.valuation
-    
-    
+        self.valuation = self.market.exit_multiples.sample_one(rng.random())*self.valuation
+
     def get_firm_value(self):
         return self.valuation * self.firm_ownership
 
-    def fail(self):
-        self.age += 1
-        self.state = 'Failed'
+    def fail(self, period):
+        self.exit_period = period
+        self.state_code = FAILED
         self.valuation = 0
-    
-    ## Function just for aging company - only used when a company is already failed or acquired, and we want to track age anyway
-    def age_company(self):
-        self.age += 1
+
+    ## A company ages every period until it exits, so its age is derived rather than counted
+    def get_age(self, num_periods):
+        return num_periods if self.exit_period < 0 else self.exit_period + 1
     
     def get_numerical_stage(self):
-        return self.market_constraints['stages'].index(self.stage)
+        return self.stage_id
+
+    ## Cheap copy used to stamp every scenario's portfolio out of a single template portfolio
+    def copy(self):
+        company = Company.__new__(Company)
+        company.name = self.name
+        company.stage_id = self.stage_id
+        company.valuation = self.valuation
+        company.state_code = self.state_code
+        company.firm_invested_capital = self.firm_invested_capital
+        company.firm_ownership = self.firm_ownership
+        company.market = self.market
+        company.exit_period = self.exit_period
+        return company
 
     def __str__(self):
         return '[' + self.name + ', ' + self.stage + ', ' + str(self.valuation) + ', ' + self.state + ', ' + str(self.firm_invested_capital) + ', ' + str(self.firm_ownership) + ']'
@@ -112,13 +313,14 @@ class Firm:
         self.follow_on_reserve = follow_on_reserve
         self.primary_capital_deployed = 0
         self.follow_on_capital_deployed = 0
+        self.follow_on_by_period = {}
         self.fund_size = fund_size
         self.firm_lifespan_years = firm_lifespan_years
         self.portfolio = []
     
     ## Initialize portfolio with full set of companies, with initial investments
-    ## Take as input the full set of stages, valuations, and dilutions for each stage so that an individual company can run it's own operations on itself
-    def initialize_portfolio(self, stages, valuations, dilution):
+    ## Take as input the shared market model so that an individual company can run it's own operations on itself
+    def initialize_portfolio(self, market):
         
         ## For each primary investment type (e.g., pre-seed or seed)
         for primary_capital_rounds in self.primary_investments:
@@ -134,15 +336,14 @@ class Firm:
             ## While we have capital left for this type of investment, initialize a company in the portfolio at that stage
             while capital_to_be_allocated > 0 and capital_to_be_allocated >= capital_invested_per_company:
                 
+                stage_valuation = market.valuations[market.stage_ids[stage_invested]]
                 self.portfolio.append(Company('comp_name' + stage_invested[:2] + str(capital_to_be_allocated), 
                                             stage_invested, 
-                                            valuations[stage_invested],
+                                            stage_valuation,
                                             'Alive', 
                                             capital_invested_per_company, 
-                                            capital_invested_per_company/valuations[stage_invested],
-                                            stages, 
-                                            valuations, 
-                                            dilution))
+                                            capital_invested_per_company/stage_valuation,
+                                            market))
                 
                 ## We have just made an investment, so decrease the amount of remaining capital_to_be_allocated by how much we invested (capital_invested_per_company), and update the amount of primary capital deployed
                 capital_to_be_allocated -= capital_invested_per_company
@@ -156,15 +357,20 @@ class Firm:
         # print('----------------------------------------------------------')
     
     
+    ## Start from a copy of another firm's (freshly initialized) portfolio instead of re-running the allocation loop
+    def copy_portfolio(self, template_firm):
+        self.portfolio = [company.copy() for company in template_firm.portfolio]
+        self.primary_capital_deployed = template_firm.primary_capital_deployed
+
     ## Concise view of companies alive, failed, acquired
     def concise_portfolio_value(self):
         total_value = 0
         for portco in self.portfolio:
-            if portco.state == 'Alive':
+            if portco.state_code == ALIVE:
                 total_value += portco.valuation * portco.firm_ownership
-            elif portco.state == 'Failed':
+            elif portco.state_code == FAILED:
                 total_value += 0
-            elif portco.state == 'Acquired':
+            elif portco.state_code == ACQUIRED:
                 total_value += portco.valuation * portco.firm_ownership
         return total_value
 
@@ -176,9 +382,9 @@ class Firm:
         }
         for portco in self.portfolio:
             # print(portco.stage, portco.state, '-- val', portco.valuation, 'return', portco.valuation*portco.firm_ownership, 'ic', portco.firm_invested_capital, 'ownership', portco.firm_ownership)
-            if portco.state == 'Alive':
+            if portco.state_code == ALIVE:
                 total_value['Alive'] += portco.valuation * portco.firm_ownership
-            elif portco.state == 'Acquired':
+            elif portco.state_code == ACQUIRED:
                 total_value['Acquired'] += portco.valuation * portco.firm_ownership
         return total_value
 
@@ -189,13 +395,28 @@ class Firm:
     def get_remaining_follow_on_capital(self):
         return self.follow_on_reserve - self.follow_on_capital_deployed
     
-    def get_irr(self):
-        # fv = self.concise_portfolio_value()
-        # pv = self.primary_capital_deployed + self.follow_on_capital_deployed
-        # # print(fv, pv)
-        # IRR = ((fv / pv) ** (1/self.firm_lifespan_years)) -1
-        # return IRR
-        print ('ERROR: ' + 'IRR not implemented')
+    ## Record pro rata paid out of the follow-on reserve in a given period
+    def deploy_follow_on(self, period, amount):
+        self.follow_on_capital_deployed += amount
+        self.follow_on_by_period[period] = self.follow_on_by_period.get(period, 0) + amount
+
+    def get_cash_flows(self, num_periods):
+        ''' Net cash flow at the end of each of num_periods periods, with the primary checks at period 0: pro rata goes out and M&A proceeds come in
+        at the end of the period they happen in, and companies still alive are marked at their valuation at the end of the fund's life'''
+        cash_flows = np.zeros(num_periods + 1)
+        cash_flows[0] -= self.primary_capital_deployed
+        for period, amount in self.follow_on_by_period.items():
+            cash_flows[period + 1] -= amount
+        for portco in self.portfolio:
+            if portco.state_code == ACQUIRED:
+                cash_flows[portco.exit_period + 1] += portco.get_firm_value()
+            elif portco.state_code == ALIVE:
+                cash_flows[num_periods] += portco.get_firm_value()
+        return cash_flows
+
+    def get_irr(self, num_periods):
+        years = np.arange(num_periods + 1)*self.firm_lifespan_years/num_periods
+        return float(internal_rate_of_return(self.get_cash_flows(num_periods)[None, :], years)[0])
 
     def get_MoM(self):
         MoM = round(self.concise_portfolio_value()/self.get_capital_invested(), 1)
@@ -220,19 +441,383 @@ class Firm:
         #     'Acquired': 0
         # }
         for comp in self.portfolio:
-            if comp.state == 'Alive':
+            if comp.state_code == ALIVE:
                 f[comp.stage] += 1
                 # f['Alive'] += 1
-            elif comp.state == 'Failed':
+            elif comp.state_code == FAILED:
                 f['Failed'] += 1
-            elif comp.state == 'Acquired':
+            elif comp.state_code == ACQUIRED:
                 f['Acquired'] += 1 
         return str(f)
     
     # def check_portfolio(self):
-    #     ages = [company.age for company in self.portfolio]
+    #     ages = [company.get_age(num_periods) for company in self.portfolio]
     #     ## print(ages)
-        
+
+
+#############################################################################
+#############################################################################
+####################### SCENARIO ARRAYS CLASS ###############################
+#############################################################################
+#############################################################################
+
+class ScenarioArrays:
+    ''' Every simulated firm held as scenario x company arrays. Row i is the portfolio of scenario i, column j is the j-th company in portfolio order.
+    Mirrors the Firm / Company API so that results can be read the same way for either engine.'''
+
+    def __init__(self, num_scenarios, stage, valuation, firm_invested_capital, firm_ownership, primary_capital_deployed, follow_on_reserve, num_periods=0):
+
+        ## Per-company state, broadcast from a single template portfolio row to every scenario
+        self.stage = np.repeat(np.asarray(stage, dtype=np.int8)[None, :], num_scenarios, axis=0)
+        self.state = np.full(self.stage.shape, ALIVE, dtype=np.int8)
+        self.valuation = np.repeat(np.asarray(valuation, dtype=np.float64)[None, :], num_scenarios, axis=0)
+        self.firm_invested_capital = np.repeat(np.asarray(firm_invested_capital, dtype=np.float64)[None, :], num_scenarios, axis=0)
+        self.firm_ownership = np.repeat(np.asarray(firm_ownership, dtype=np.float64)[None, :], num_scenarios, axis=0)
+        self.exit_period = np.full(self.stage.shape, -1, dtype=np.int8)
+
+        ## Per-scenario firm state
+        self.primary_capital_deployed = np.full(num_scenarios, primary_capital_deployed, dtype=np.float64)
+        self.follow_on_capital_deployed = np.zeros(num_scenarios)
+        self.follow_on_reserve = np.full(num_scenarios, follow_on_reserve, dtype=np.float64)
+
+        ## Value of the extra (reserve-recycled) investments made at the end of each scenario, split by state
+        self.extra_alive_value = np.zeros(num_scenarios)
+        self.extra_acquired_value = np.zeros(num_scenarios)
+        self.num_extra_investments = np.zeros(num_scenarios, dtype=np.int64)
+
+        ## Dated cash flows: pro rata paid and extra investments' M&A proceeds in each period
+        self.follow_on_by_period = np.zeros((num_scenarios, num_periods))
+        self.extra_exit_proceeds = np.zeros((num_scenarios, num_periods))
+
+    ## Every per-scenario array, in the order they are stored
+    fields = ('stage', 'state', 'valuation', 'firm_invested_capital', 'firm_ownership', 'exit_period',
+              'primary_capital_deployed', 'follow_on_capital_deployed', 'follow_on_reserve',
+              'extra_alive_value', 'extra_acquired_value', 'num_extra_investments',
+              'follow_on_by_period', 'extra_exit_proceeds')
+
+    ## The per-company arrays (scenario x company)
+    company_fields = ('stage', 'state', 'valuation', 'firm_invested_capital', 'firm_ownership', 'exit_period')
+
+    def truncate_companies(self, num_companies):
+        ''' Keep only the first num_companies company slots of every scenario'''
+        for name in self.company_fields:
+            setattr(self, name, getattr(self, name)[:, :num_companies])
+
+    @classmethod
+    def concatenate(cls, parts):
+        ''' Stack the scenarios of several ScenarioArrays (e.g., shards simulated in different processes) into one'''
+        arrays = cls.__new__(cls)
+        for name in cls.fields:
+            setattr(arrays, name, np.concatenate([getattr(part, name) for part in parts]))
+        return arrays
+
+    @classmethod
+    def from_firms(cls, firms, num_portfolio_companies, num_periods=0):
+        ''' Convert simulated Firm objects into arrays. The first num_portfolio_companies of each portfolio are the primary investments, anything after that is an extra investment'''
+        arrays = cls.__new__(cls)
+        portfolios = [firm.portfolio[:num_portfolio_companies] for firm in firms]
+        extras = [firm.portfolio[num_portfolio_companies:] for firm in firms]
+        arrays.stage = np.array([[company.stage_id for company in portfolio] for portfolio in portfolios], dtype=np.int8).reshape(len(firms), num_portfolio_companies)
+        arrays.state = np.array([[company.state_code for company in portfolio] for portfolio in portfolios], dtype=np.int8).reshape(len(firms), num_portfolio_companies)
+        arrays.valuation = np.array([[company.valuation for company in portfolio] for portfolio in portfolios], dtype=np.float64).reshape(len(firms), num_portfolio_companies)
+        arrays.firm_invested_capital = np.array([[company.firm_invested_capital for company in portfolio] for portfolio in portfolios], dtype=np.float64).reshape(len(firms), num_portfolio_companies)
+        arrays.firm_ownership = np.array([[company.firm_ownership for company in portfolio] for portfolio in portfolios], dtype=np.float64).reshape(len(firms), num_portfolio_companies)
+        arrays.exit_period = np.array([[company.exit_period for company in portfolio] for portfolio in portfolios], dtype=np.int8).reshape(len(firms), num_portfolio_companies)
+        arrays.primary_capital_deployed = np.array([firm.primary_capital_deployed for firm in firms], dtype=np.float64)
+        arrays.follow_on_capital_deployed = np.array([firm.follow_on_capital_deployed for firm in firms], dtype=np.float64)
+        arrays.follow_on_reserve = np.array([firm.follow_on_reserve for firm in firms], dtype=np.float64)
+        arrays.extra_alive_value = np.array([sum(company.get_firm_value() for company in extra if company.state_code == ALIVE) for extra in extras], dtype=np.float64)
+        arrays.extra_acquired_value = np.array([sum(company.get_firm_value() for company in extra if company.state_code == ACQUIRED) for extra in extras], dtype=np.float64)
+        arrays.num_extra_investments = np.array([len(extra) for extra in extras], dtype=np.int64)
+        arrays.follow_on_by_period = np.zeros((len(firms), num_periods))
+        arrays.extra_exit_proceeds = np.zeros((len(firms), num_periods))
+        for i, (firm, extra) in enumerate(zip(firms, extras)):
+            for period, amount in firm.follow_on_by_period.items():
+                arrays.follow_on_by_period[i, period] += amount
+            for company in extra:
+                if company.state_code == ACQUIRED:
+                    arrays.extra_exit_proceeds[i, company.exit_period] += company.get_firm_value()
+        return arrays
+
+    def __len__(self):
+        return self.stage.shape[0]
+
+    def concise_portfolio_value(self):
+        ## Failed companies have a valuation of 0, so they drop out of the sum
+        return (self.valuation * self.firm_ownership).sum(axis=1) + self.extra_alive_value + self.extra_acquired_value
+
+    def detailed_portfolio_value(self):
+        value = self.valuation * self.firm_ownership
+        return {
+            'Alive': np.where(self.state == ALIVE, value, 0).sum(axis=1) + self.extra_alive_value,
+            'Acquired': np.where(self.state == ACQUIRED, value, 0).sum(axis=1) + self.extra_acquired_value
+        }
+
+    def get_capital_invested(self):
+        return self.primary_capital_deployed + self.follow_on_capital_deployed
+
+    def get_remaining_follow_on_capital(self):
+        return self.follow_on_reserve - self.follow_on_capital_deployed
+
+    def get_MoM(self):
+        return np.round(self.concise_portfolio_value()/self.get_capital_invested(), 1)
+
+    def acquisition_proceeds(self, funded=None):
+        ''' M&A proceeds per scenario and period (companies outside the funded mask are left out)'''
+        num_scenarios, num_periods = self.follow_on_by_period.shape
+        acquired = self.state == ACQUIRED
+        if funded is not None:
+            acquired &= funded
+        scenario, company = np.nonzero(acquired)
+        proceeds = np.bincount(scenario*num_periods + self.exit_period[scenario, company], weights=self.valuation[scenario, company]*self.firm_ownership[scenario, company],
+                               minlength=num_scenarios*num_periods)
+        return proceeds.reshape(num_scenarios, num_periods)
+
+    def cash_flows(self):
+        ''' Net cash flow per scenario at the end of each period, same layout as Firm.get_cash_flows'''
+        num_scenarios, num_periods = self.follow_on_by_period.shape
+        cash_flows = np.zeros((num_scenarios, num_periods + 1))
+        cash_flows[:, 0] -= self.primary_capital_deployed
+        cash_flows[:, 1:] += self.acquisition_proceeds() + self.extra_exit_proceeds - self.follow_on_by_period
+        cash_flows[:, num_periods] += self.detailed_portfolio_value()['Alive']
+        return cash_flows
+
+    def scenario_repr(self, index, stages):
+        ''' Same summary as Firm.__repr__ for a single scenario (extra investments are not tracked per stage)'''
+        f = {stage: 0 for stage in stages}
+        f['Failed'] = 0
+        f['Acquired'] = 0
+        for stage_id, state in zip(self.stage[index], self.state[index]):
+            if state == ALIVE:
+                f[stages[stage_id]] += 1
+            else:
+                f[state_names[state]] += 1
+        return str(f)
+
+
+#############################################################################
+#############################################################################
+###################### TRAJECTORY RECORDER CLASS ############################
+#############################################################################
+#############################################################################
+class TrajectoryRecorder:
+    ''' Opt-in record of every primary portfolio company's stage, state and firm value at the end of every period (column 0 is the starting portfolio),
+    held in scenario x company x period int8 / float32 arrays. Extra investments are kept as per-scenario alive and acquired totals, and paid-in capital
+    as a per-scenario running total, which is all the NAV, DPI and TVPI curves need.'''
+
+    def __init__(self, num_scenarios, num_companies, num_periods):
+        self.stage = np.zeros((num_scenarios, num_companies, num_periods + 1), dtype=np.int8)
+        self.state = np.zeros((num_scenarios, num_companies, num_periods + 1), dtype=np.int8)
+        self.value = np.zeros((num_scenarios, num_companies, num_periods + 1), dtype=np.float32)
+        self.extra_alive_value = np.zeros((num_scenarios, num_periods + 1), dtype=np.float32)
+        self.extra_acquired_value = np.zeros((num_scenarios, num_periods + 1), dtype=np.float32)
+        self.paid_in = np.zeros((num_scenarios, num_periods + 1), dtype=np.float32)
+
+    ## Vectorized engine: every scenario at once
+    def record(self, period, arrays):
+        self.stage[:, :, period] = arrays.stage
+        self.state[:, :, period] = arrays.state
+        self.value[:, :, period] = arrays.valuation*arrays.firm_ownership
+
+    def record_extras(self, period, state, value, funded):
+        value = np.where(funded, value, 0)
+        self.extra_alive_value[:, period] = np.where(state == ALIVE, value, 0).sum(axis=1)
+        self.extra_acquired_value[:, period] = np.where(state == ACQUIRED, value, 0).sum(axis=1)
+
+    ## Object engine: one firm at a time
+    def record_companies(self, index, period, companies):
+        self.stage[index, :, period] = [company.stage_id for company in companies]
+        self.state[index, :, period] = [company.state_code for company in companies]
+        self.value[index, :, period] = [company.get_firm_value() for company in companies]
+
+    def record_extra_companies(self, index, period, companies):
+        self.extra_alive_value[index, period] = sum(company.get_firm_value() for company in companies if company.state_code == ALIVE)
+        self.extra_acquired_value[index, period] = sum(company.get_firm_value() for company in companies if company.state_code == ACQUIRED)
+
+    def record_paid_in(self, index, primary_capital_deployed, follow_on_by_period):
+        ''' Paid-in capital at the end of each period: primary checks (extra investments included) from period 0, plus pro rata as it is paid'''
+        primary_capital_deployed = np.asarray(primary_capital_deployed)
+        self.paid_in[index, 0] = primary_capital_deployed
+        self.paid_in[index, 1:] = primary_capital_deployed[..., None] + np.cumsum(follow_on_by_period, axis=-1)
+
+    def nav(self):
+        ''' Value of the companies still alive, per scenario and period'''
+        return np.where(self.state == ALIVE, self.value, 0).sum(axis=1, dtype=np.float64) + self.extra_alive_value
+
+    def distributions(self):
+        ''' Cumulative M&A proceeds, per scenario and period'''
+        return np.where(self.state == ACQUIRED, self.value, 0).sum(axis=1, dtype=np.float64) + self.extra_acquired_value
+
+    def dpi(self):
+        return self.distributions()/self.paid_in
+
+    def tvpi(self):
+        return (self.nav() + self.distributions())/self.paid_in
+
+    def percentile_bands(self, curve='TVPI', percentiles=(10, 25, 50, 75, 90)):
+        ''' Percentiles across scenarios of a curve ('NAV', 'DPI' or 'TVPI') at every period'''
+        curves = {'NAV': self.nav, 'DPI': self.dpi, 'TVPI': self.tvpi}[curve]()
+        return {p: np.percentile(curves, p, axis=0) for p in percentiles}
+
+
+def allocate_follow_on(desired, remaining, valuation=None):
+    ''' First-come-first-served pro rata: company j gets what it asks for until the scenario's remaining reserve runs out.
+    The capital handed out to the first j companies is min(cumulative ask, reserve), so each company's share is the step in that capped sum.'''
+    capped = np.minimum(np.cumsum(desired, axis=1), remaining[:, None])
+    return np.diff(capped, axis=1, prepend=0)
+
+
+def allocate_follow_on_by_valuation(desired, remaining, valuation):
+    ''' Top-valued first: the same capped running sum, taken over the companies ordered by post-round valuation (ties in portfolio order),
+    so when the reserve runs short only the highest-valued companies get their pro rata.'''
+    order = np.argsort(-valuation, axis=1, kind='stable')
+    allocation = np.empty_like(desired)
+    np.put_along_axis(allocation, order, allocate_follow_on(np.take_along_axis(desired, order, axis=1), remaining), axis=1)
+    return allocation
+
+
+def allocate_follow_on_evenly(desired, remaining, valuation=None):
+    ''' Even split: every company asking for pro rata gets the same share of the remaining reserve, capped at its ask, and whatever the capped
+    companies leave over is shared among the rest. Sorting the asks finds the share at which the reserve runs out.'''
+    asks = np.sort(desired, axis=1)
+    num_companies = asks.shape[1]
+    if num_companies == 0:
+        return desired
+
+    ## If the share were the k-th smallest ask, the reserve used would be the smaller asks in full plus that ask for every company from k on
+    asked_below = np.cumsum(asks, axis=1) - asks
+    companies_from = num_companies - np.arange(num_companies)
+    short = asked_below + asks*companies_from > remaining[:, None]
+    first_short = short.argmax(axis=1)
+    share = (remaining - asked_below[np.arange(len(asks)), first_short])/companies_from[first_short]
+    share = np.where(short.any(axis=1), np.maximum(share, 0), np.inf)
+    return np.minimum(desired, share[:, None])
+
+
+## How the vectorized engine splits a short follow-on reserve between the companies asking for pro rata in the same period.
+## Each takes (desired, remaining, valuation) and returns the allocation; all of them give every company its full ask when the reserve covers it.
+follow_on_policies = {
+    'first_come': allocate_follow_on,
+    'top_valued': allocate_follow_on_by_valuation,
+    'even_split': allocate_follow_on_evenly
+}
+
+
+#############################################################################
+#############################################################################
+########################## RANDOM DRAWS CLASSES #############################
+#############################################################################
+#############################################################################
+class UniformDraws:
+    ''' A source of uniform draws for the vectorized engine: uniforms(kind, period, shape) gives one draw per scenario and company slot for a
+    kind of decision ('decision', 'm_and_a', or the same for the 'extra_' investments) in a period'''
+
+    def uniforms_at(self, kind, period, shape, scenario, company):
+        ''' Just the draws of the (scenario, company) cells the engine needs'''
+        return self.uniforms(kind, period, shape)[scenario, company]
+
+
+class StreamDraws(UniformDraws):
+    ''' Uniform draws for the vectorized engine taken one batch after another from a single numpy Generator'''
+
+    def __init__(self, generator):
+        self.generator = generator
+
+    def uniforms(self, kind, period, shape):
+        return self.generator.random(shape)
+
+
+class CommonRandomDraws(UniformDraws):
+    ''' Common random numbers: the draw for (kind, period, scenario, company slot) depends only on the seed, never on the rest of the portfolio.
+    Each (kind, period) gets its own stream, filled company slot by company slot, so two fund configurations run with the same seed see
+    the same fate draws for their first companies, and their difference is measured without the noise of independent samples.'''
+
+    kinds = ('decision', 'm_and_a', 'extra_decision', 'extra_m_and_a')
+
+    def __init__(self, seed_sequence):
+        self.seed_sequence = seed_sequence
+
+    def uniforms(self, kind, period, shape):
+        num_scenarios, num_companies = shape
+        stream = np.random.SeedSequence(self.seed_sequence.entropy, spawn_key=self.seed_sequence.spawn_key + (self.kinds.index(kind), period))
+        return np.random.default_rng(stream).random((num_companies, num_scenarios)).T
+
+
+## Philox4x32-10 constants: round multipliers and the Weyl sequence that bumps the key between rounds
+PHILOX_MULTIPLIERS = (np.uint64(0xD2511F53), np.uint64(0xCD9E8D57))
+PHILOX_KEY_BUMPS = (np.uint64(0x9E3779B9), np.uint64(0xBB67AE85))
+UINT32_MASK = np.uint64(0xFFFFFFFF)
+
+
+def philox4x32(counter, key, rounds=10):
+    ''' Philox4x32-10 counter-based generator (Salmon et al., "Parallel random numbers: as easy as 1, 2, 3"): maps four 32-bit counter words and
+    two 32-bit key words to four random 32-bit words. The counter words can be arrays of any broadcastable shapes, so a whole grid is hashed at once.'''
+    c0, c1, c2, c3 = (np.asarray(word, dtype=np.uint64) for word in counter)
+    k0, k1 = np.uint64(key[0]), np.uint64(key[1])
+    for round in range(rounds):
+        product0 = PHILOX_MULTIPLIERS[0]*c0
+        product1 = PHILOX_MULTIPLIERS[1]*c2
+        c0, c1, c2, c3 = (product1 >> np.uint64(32)) ^ c1 ^ k0, product1 & UINT32_MASK, (product0 >> np.uint64(32)) ^ c3 ^ k1, product0 & UINT32_MASK
+        k0 = (k0 + PHILOX_KEY_BUMPS[0]) & UINT32_MASK
+        k1 = (k1 + PHILOX_KEY_BUMPS[1]) & UINT32_MASK
+    return c0, c1, c2, c3
+
+
+## Known-answer vectors from the Random123 distribution (counter, key, output), checked by test_montecarlo_simulation.py
+PHILOX_KNOWN_ANSWERS = (
+    ((0x00000000, 0x00000000, 0x00000000, 0x00000000), (0x00000000, 0x00000000), (0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8)),
+    ((0xffffffff, 0xffffffff, 0xffffffff, 0xffffffff), (0xffffffff, 0xffffffff), (0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd)),
+    ((0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344), (0xa4093822, 0x299f31d0), (0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1))
+)
+
+
+class CounterDraws(UniformDraws):
+    ''' Counter-based draws: the uniform for (kind, period, scenario, company slot) is Philox of that tuple under a key taken from the root seed,
+    where scenario is the scenario's index in the whole run (first_scenario is the index of this batch's first row). Nothing is carried from one draw
+    to the next, so any scenario can be regenerated on its own (Montecarlo.replay_scenario), batches and shards give the same scenarios however the
+    run is split, and like common random numbers, the draws of a company slot never depend on the rest of the portfolio.'''
+
+    kinds = ('decision', 'm_and_a', 'extra_decision', 'extra_m_and_a')
+
+    def __init__(self, key, first_scenario=0):
+        self.key = key
+        self.first_scenario = first_scenario
+
+    def uniforms(self, kind, period, shape):
+        num_scenarios, num_companies = shape
+        return self.uniforms_at(kind, period, shape, np.arange(num_scenarios)[:, None], np.arange(num_companies)[None, :])
+
+    def uniforms_at(self, kind, period, shape, scenario, company):
+        ## Only the requested cells are hashed, so dead companies cost nothing
+        scenario = np.asarray(scenario, dtype=np.uint64) + np.uint64(self.first_scenario)
+        words = philox4x32((company, self.kinds.index(kind) << 16 | period, scenario & UINT32_MASK, scenario >> np.uint64(32)), self.key)
+
+        ## 53 random bits from two of the words, the same way numpy turns raw bits into a double in [0, 1)
+        return ((words[0] >> np.uint64(5)).astype(np.float64)*67108864 + (words[1] >> np.uint64(6)).astype(np.float64))/9007199254740992
+
+
+## Sampling strategies for the vectorized engine's uniform draws
+sampling_strategies = {
+    'plain': StreamDraws,
+    'counter': CounterDraws
+}
+
+
+def simulate_shard(num_scenarios, stages, stage_probs, stage_valuations, stage_dilution, firm_attributes, engine, seed, streaming=False, common_random_numbers=False, sampling='plain', follow_on_policy='first_come', exit_multiples=None, scenario_offset=0):
+    ''' Run one shard of a parallel simulation in a worker process and hand back its scenarios as ScenarioArrays (or just its accumulators when streaming).
+    scenario_offset is the index of the shard's first scenario in the whole run, which counter-based draws are keyed on.'''
+    montecarlo = Montecarlo(num_scenarios, stages, stage_probs, stage_valuations, stage_dilution, firm_attributes, engine=engine, seed=seed,
+                            common_random_numbers=common_random_numbers, sampling=sampling, follow_on_policy=follow_on_policy, exit_multiples=exit_multiples)
+    montecarlo.scenario_offset = scenario_offset
+    if streaming:
+        montecarlo.simulate_streaming()
+        return montecarlo.streaming_statistics
+    montecarlo.initialize_scenarios()
+    montecarlo.simulate()
+    if montecarlo.scenario_arrays is not None:
+        return montecarlo.scenario_arrays
+    return ScenarioArrays.from_firms(montecarlo.firm_scenarios, len(montecarlo.portfolio_template()[0]), firm_attributes['firm_lifespan_periods'])
+
 
 #############################################################################################################################################
 #############################################################################################################################################
@@ -242,168 +827,767 @@ class Firm:
 class Montecarlo:
     ''' The Montecarlo class simulates a firm's investing lifecycle'''
     
-    def __init__(self, num_scenarios, stages, stage_probs, stage_valuations, stage_dilution, firm_attributes):
+    def __init__(self, num_scenarios, stages, stage_probs, stage_valuations, stage_dilution, firm_attributes, engine='object', seed=None, common_random_numbers=False, sampling='plain', record_trajectories=False, follow_on_policy='first_come', exit_multiples=None):
         
         ## Each scenario is a firm that is simulated from the initialization of their portfolio to the end of their funds lifespan (i.e., after ~10yrs)
         self.num_scenarios = num_scenarios
         self.firm_scenarios = []
+
+        ## 'object' simulates Firm / Company objects one at a time, 'vectorized' simulates every scenario at once as ScenarioArrays,
+        ## 'exact' computes the outcome distribution without sampling when the companies are independent (see simulate_exact), and simulates otherwise
+        if engine not in ('object', 'vectorized', 'exact'):
+            raise ValueError('Unknown engine: ' + str(engine))
+        self.engine = engine
+        self.scenario_arrays = None
+
+        ## Root seed for every random draw: an int, a np.random.SeedSequence or a np.random.Generator. No global random state is touched.
+        ## With no seed, fresh entropy is drawn once and kept in self.seed, so any run can be reproduced afterwards
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+
+        ## Every stream is derived from one SeedSequence, built here: a Generator seed gives up its entropy once, so repeated calls agree
+        if isinstance(self.seed, np.random.SeedSequence):
+            self.root_seed_sequence = self.seed
+        elif isinstance(self.seed, np.random.Generator):
+            self.root_seed_sequence = np.random.SeedSequence(int(self.seed.integers(2**63)))
+        else:
+            self.root_seed_sequence = np.random.SeedSequence(self.seed)
+
+        ## Common random numbers give every (scenario, company slot, period) the same draws across configurations with the same seed (vectorized engine only).
+        ## A Generator is advanced by every configuration that draws from it, so two configurations given the same one would not share draws
+        if common_random_numbers and engine != 'vectorized':
+            raise ValueError('common_random_numbers requires the vectorized engine')
+        if common_random_numbers and isinstance(self.seed, np.random.Generator):
+            raise ValueError('common_random_numbers needs a reproducible seed (an int or a np.random.SeedSequence), not a np.random.Generator')
+        self.common_random_numbers = common_random_numbers
+
+        ## How the vectorized engine's uniforms are drawn: 'plain' (one Generator stream) or 'counter' (Philox keyed by scenario index, so any scenario
+        ## can be replayed on its own with replay_scenario())
+        if sampling not in sampling_strategies:
+            raise ValueError('Unknown sampling strategy: ' + str(sampling))
+        if sampling != 'plain' and (engine != 'vectorized' or common_random_numbers):
+            raise ValueError('Counter-based sampling requires the vectorized engine without common_random_numbers')
+        self.sampling = sampling
+
+        ## Index of this run's first scenario (for shards of a larger run) and the Philox key, for counter-based draws
+        self.scenario_offset = 0
+        self.key = None
+
+        ## Who gets pro rata when the follow-on reserve can't cover every ask in a period: 'first_come' (portfolio order), 'top_valued' or 'even_split'.
+        ## The object engine hands out the reserve one company at a time, so it only does 'first_come'
+        if follow_on_policy not in follow_on_policies:
+            raise ValueError('Unknown follow-on policy: ' + str(follow_on_policy))
+        if follow_on_policy != 'first_come' and engine == 'object':
+            raise ValueError('Follow-on policies other than first_come require the vectorized or exact engine')
+        self.follow_on_policy = follow_on_policy
+
+        ## Per-scenario outcomes, built once at the end of simulate() / simulate_parallel()
+        self.result = None
+
+        ## Filled in by simulate_streaming() instead of keeping every firm around
+        self.streaming_statistics = None
+
+        ## Starting portfolio, built once and copied into every scenario's firm
+        self.template_firm = None
+
+        ## Filled in by simulate_adaptive(): scenarios used and the precision reached on each percentile
+        self.precision = None
+
+        ## Filled in by control_variate_estimates()
+        self.control_variate = None
+
+        ## Filled in by simulate_streaming(store_path=...): the ResultStore written to disk, reopened read-only
+        self.store = None
+
+        ## With record_trajectories, simulate() keeps every company's path in a TrajectoryRecorder (self.trajectories)
+        self.record_trajectories = record_trajectories
+        self.trajectories = None
         
-        ## These are all variables that are needed to calculate the probability of companies moving on to the next stage, the corresponding dilution, and valuations
+        ## These are all variables that are needed to calculate the probability of companies moving on to the next stage, the corresponding dilution, and valuations,
+        ## plus the distribution of M&A exit multiples (the default ExitMultiples table if None)
         self.stages = stages
         self.stage_probs = stage_probs
         self.stage_valuations = stage_valuations
         self.stage_dilution = stage_dilution
+        self.market = MarketModel(stages, stage_probs, stage_valuations, stage_dilution, exit_multiples)
         
         ## Firm attributes contain information about firm's entry point (e.g., pre-seed vs seed), fund size, primary vs. follow-on capital
         self.firm_attributes = firm_attributes
     
+    def cache_key(self):
+        ''' Hash of everything that determines this simulation's outcomes, for looking up cached results.
+        None when the seed is a np.random.Generator: its state can't be hashed and the run can't be reproduced, so it is never cached.'''
+        if isinstance(self.seed, np.random.Generator):
+            return None
+        return canonical_hash(ENGINE_VERSION, self.engine, self.sampling, self.follow_on_policy, self.common_random_numbers, self.num_scenarios, self.seed,
+                              self.firm_attributes, self.stages, self.stage_probs, self.stage_valuations, self.stage_dilution, self.market.exit_multiples.params())
+
     def initialize_scenarios(self):
 
+        ## The exact engine has no scenarios to build
+        if self.engine == 'exact':
+            return
+
+        if self.engine == 'vectorized':
+            self.scenario_arrays = self.build_scenario_arrays(self.num_scenarios)
+            return
+
         ## Initialize the firm_scenarios list with a new firm for each simulated scenario
         for i in range(self.num_scenarios):
-            
-            ## Create the firm object
-            new_firm = Firm('Gradient'+ str(i), 
-                            self.firm_attributes['primary_investments'], 
-                            self.firm_attributes['follow_on_reserve'], 
-                            self.firm_attributes['fund_size'], 
-                            self.firm_attributes['firm_lifespan_years'])
-            
-            ## Initialize the portfolio inside that firm
-            new_firm.initialize_portfolio(self.stages, self.stage_valuations, self.stage_dilution)
-            self.firm_scenarios.append(new_firm)
+            self.firm_scenarios.append(self.build_firm(i))
+
+    def build_firm(self, i):
+
+        ## Create the firm object
+        new_firm = Firm('Gradient'+ str(i), 
+                        self.firm_attributes['primary_investments'], 
+                        self.firm_attributes['follow_on_reserve'], 
+                        self.firm_attributes['fund_size'], 
+                        self.firm_attributes['firm_lifespan_years'])
+        
+        ## Every scenario starts from the same portfolio, so run the allocation loop once and stamp copies of it afterwards
+        if self.template_firm is None:
+            self.template_firm = Firm('Template', 
+                                      self.firm_attributes['primary_investments'], 
+                                      self.firm_attributes['follow_on_reserve'], 
+                                      self.firm_attributes['fund_size'], 
+                                      self.firm_attributes['firm_lifespan_years'])
+            self.template_firm.initialize_portfolio(self.market)
+        new_firm.copy_portfolio(self.template_firm)
+        return new_firm
         
     
     ################################################################################################################################################################################################
     ################################################################ Contains core simulation logic for Montecarlo simulation ######################################################################
     ################################################################################################################################################################################################
     def simulate(self):
-        ## Re-seed random number generator 
-        random.seed(time.time())
+        if self.engine == 'exact':
+            reason = self.exact_engine_blocker()
+            if reason is None:
+                self.simulate_exact()
+                return
+            print('Exact engine unavailable (' + reason + '), falling back to the vectorized simulation')
+            self.engine = 'vectorized'
+            self.initialize_scenarios()
+
+        if self.record_trajectories:
+            self.trajectories = TrajectoryRecorder(self.num_scenarios, len(self.portfolio_template()[0]), self.firm_attributes['firm_lifespan_periods'])
+
+        if self.engine == 'vectorized':
+            self.simulate_vectorized(self.scenario_arrays, self.random_draws(self.generator()), self.trajectories)
+            self.result = SimulationResult.from_scenario_arrays(self.scenario_arrays, self.cash_flow_years())
+            return
+
+        rng = self.python_random()
 
         ## For each firm that we want to simulate, run the simulation
-        for firm in self.firm_scenarios:
-            ## Iteratively age companies in portfolio, deploying any secondary capital available, and rendering a judgement based on random outcomes about how a company performs
-            ## Each portfolio is aged for a set number of periods, which for the purposes of this simulation, is roughly 11 / 1.5yrs = 7 periods
+        for index, firm in enumerate(self.firm_scenarios):
+            self.simulate_firm(firm, rng, self.trajectories, index)
+        self.result = SimulationResult.from_firms(self.firm_scenarios, self.cash_flow_years())
+
+    ## Random number sources, all derived from self.seed
+    def seed_sequence(self):
+        return self.root_seed_sequence
+
+    def generator(self):
+        if isinstance(self.seed, np.random.Generator):
+            return self.seed
+        return np.random.default_rng(self.seed_sequence())
+
+    def python_random(self):
+        ## The object engine draws one number at a time, which is much faster from a random.Random instance than from a numpy Generator
+        return random.Random(int(self.seed_sequence().generate_state(1, np.uint64)[0]))
+
+    def cash_flow_years(self):
+        ''' Time in years of each cash flow date: period 0 (the primary checks) to the end of the fund's life'''
+        num_periods = self.firm_attributes['firm_lifespan_periods']
+        return np.arange(num_periods + 1)*self.firm_attributes['firm_lifespan_years']/num_periods
+
+    def counter_key(self):
+        if self.key is None:
+            self.key = tuple(int(word) for word in self.seed_sequence().generate_state(2, np.uint32))
+        return self.key
+
+    def random_draws(self, generator, batch=(), start=0):
+        ''' Draws for a batch of scenarios, the batch-th of the run, starting at scenario start'''
+        if self.sampling == 'counter':
+            return CounterDraws(self.counter_key(), self.scenario_offset + start)
+        if self.common_random_numbers:
+            seed_sequence = self.seed_sequence()
+            return CommonRandomDraws(np.random.SeedSequence(seed_sequence.entropy, spawn_key=seed_sequence.spawn_key + tuple(batch)))
+        return sampling_strategies[self.sampling](generator)
+
+    def simulate_firm(self, firm, rng, trajectories=None, index=None):
+        market = self.market
+        if trajectories is not None:
+            trajectories.record_companies(index, 0, firm.portfolio)
+
+        ## Iteratively age companies in portfolio, deploying any secondary capital available, and rendering a judgement based on random outcomes about how a company performs
+        ## Each portfolio is aged for a set number of periods, which for the purposes of this simulation, is roughly 11 / 1.5yrs = 7 periods
+        ## Only the live companies are visited, and once every company has exited (or reached the last stage) the firm's remaining periods are skipped
+        live = self.live_companies(firm.portfolio)
+        for period in range(self.firm_attributes['firm_lifespan_periods']):
+            live = self.step_companies(live, rng, period, firm)
+            if trajectories is not None:
+                trajectories.record_companies(index, period + 1, firm.portfolio)
+            elif not live:
+                break
+
+        ## If we didn't use all of our pro rata b/c our portfolio didn't do well, deploy remaining capital as primary investments
+        if firm.get_remaining_follow_on_capital() > 0:
+            extra_investments = []
+            extra_investment_type = self.firm_attributes['primary_investments'][0]
+            num_extra_investments = int(firm.get_remaining_follow_on_capital() // extra_investment_type[1])
+            for extra_investment_index in range (num_extra_investments):
+                extra_investments.append(Company('extra' + str(extra_investment_index), 
+                                        extra_investment_type[0], 
+                                        self.stage_valuations[extra_investment_type[0]],
+                                        'Alive', 
+                                        extra_investment_type[1], 
+                                        extra_investment_type[1]/self.stage_valuations[extra_investment_type[0]],
+                                        market))
+                firm.primary_capital_deployed += extra_investment_type[1]
+                firm.follow_on_reserve -= extra_investment_type[1]
+
+            if trajectories is not None:
+                trajectories.record_extra_companies(index, 0, extra_investments)
+            live = self.live_companies(extra_investments)
             for period in range(self.firm_attributes['firm_lifespan_periods']):
-                
-                ## For each company in the portfolio, determine whether to promote, fail, or M&A based on random performance
-                for company in firm.portfolio:
-                    
-                    ## If company is still alive, determine action based on random + probabilities calculation
-                    ## Probabilities in order of [next round, fail, M&A]
-                    if company.state == 'Alive' and company.get_numerical_stage() < len(self.stages)-1:
-                        rand = random.random()
-                        # print ('Company', rand, self.stage_probs[company.stage][0])
-                        if rand < self.stage_probs[company.stage][2]:
-                            company.m_and_a()
-                        elif rand < self.stage_probs[company.stage][2] + self.stage_probs[company.stage][1]:
-                            company.fail()
-                        else: 
-                            secondary_capital_consumed = company.promote(firm.get_remaining_follow_on_capital(), self.firm_attributes['pro_rata_at_or_below'])
-                            firm.follow_on_capital_deployed += secondary_capital_consumed
-                    
-                    ## If already failed or acquired, just increment age
-                    elif company.state == 'Failed':
-                        company.age_company()
-                    elif company.state == 'Acquired':
-                        company.age_company()
-        
-            
-            ## If we didn't use all of our pro rata b/c our portfolio didn't do well, deploy remaining capital as primary investments
-            if firm.get_remaining_follow_on_capital() > 0:
-                extra_investments = []
-                extra_investment_type = self.firm_attributes['primary_investments'][0]
-                num_extra_investments = int(firm.get_remaining_follow_on_capital() // extra_investment_type[1])
-                for extra_investment_index in range (num_extra_investments):
-                    extra_investments.append(Company('extra' + str(extra_investment_index), 
-                                            extra_investment_type[0], 
-                                            self.stage_valuations[extra_investment_type[0]],
-                                            'Alive', 
-                                            extra_investment_type[1], 
-                                            extra_investment_type[1]/self.stage_valuations[extra_investment_type[0]],
-                                            self.stages, 
-                                            self.stage_valuations, 
-                                            self.stage_dilution))
-                    firm.primary_capital_deployed += extra_investment_type[1]
-                    firm.follow_on_reserve -= extra_investment_type[1]
-
-                for period in range(self.firm_attributes['firm_lifespan_periods']):
-                    for company in extra_investments:
-                        if company.state == 'Alive' and company.get_numerical_stage() < len(self.stages)-1:
-                            rand = random.random()
-                            # print ('Company', rand, self.stage_probs[company.stage][0])
-                            if rand < self.stage_probs[company.stage][2]:
-                                company.m_and_a()
-                            elif rand < self.stage_probs[company.stage][2] + self.stage_probs[company.stage][1]:
-                                company.fail()
-                            else: 
-                                # No secondary capital available b/c this is the "extra" batch of companies
-                                company.promote(0, self.firm_attributes['pro_rata_at_or_below'])
-                        elif company.state == 'Failed':
-                            company.age_company()
-                        elif company.state == 'Acquired':
-                            company.age_company()
-                firm.portfolio += extra_investments
+                live = self.step_companies(live, rng, period)
+                if trajectories is not None:
+                    trajectories.record_extra_companies(index, period + 1, extra_investments)
+                elif not live:
+                    break
+            firm.portfolio += extra_investments
+
+        if trajectories is not None:
+            follow_on_by_period = np.zeros(self.firm_attributes['firm_lifespan_periods'])
+            for period, amount in firm.follow_on_by_period.items():
+                follow_on_by_period[period] += amount
+            trajectories.record_paid_in(index, firm.primary_capital_deployed, follow_on_by_period)
+
+    def live_companies(self, companies):
+        ''' The companies that can still change: alive and below the last stage (companies at the last stage just stay alive)'''
+        return [company for company in companies if company.state_code == ALIVE and company.stage_id < self.market.last_stage]
+
+    def step_companies(self, live, rng, period, firm=None):
+        ''' Age the live companies by one period, paying pro rata out of firm's reserve, and return the ones still live after it.
+        Without a firm (the "extra" batch of companies) no secondary capital is available.'''
+        market = self.market
+        still_live = []
+
+        ## For each company, determine whether to promote, fail, or M&A based on random + the market's precomputed thresholds
+        for company in live:
+            rand = rng.random()
+            if rand < market.m_and_a_threshold[company.stage_id]:
+                company.m_and_a(rng, period)
+            elif rand < market.fail_threshold[company.stage_id]:
+                company.fail(period)
+            else:
+                if firm is None:
+                    company.promote(0, self.firm_attributes['pro_rata_at_or_below'])
+                else:
+                    secondary_capital_consumed = company.promote(firm.get_remaining_follow_on_capital(), self.firm_attributes['pro_rata_at_or_below'])
+                    firm.deploy_follow_on(period, secondary_capital_consumed)
+                if company.stage_id < market.last_stage:
+                    still_live.append(company)
+        return still_live
+
+    ################################################################################################################################################################################################
+    ######################################################## Vectorized engine: the same simulation logic, run on every scenario at once ###########################################################
+    ################################################################################################################################################################################################
+    def portfolio_template(self):
+        ''' The starting portfolio as parallel lists (stage index, valuation, invested capital, ownership) plus primary capital deployed, using the same allocation loop as Firm.initialize_portfolio'''
+        stage, valuation, invested, ownership = [], [], [], []
+        primary_capital_deployed = 0
+        for stage_invested, capital_invested_per_company, capital_to_be_allocated in self.firm_attributes['primary_investments']:
+            while capital_to_be_allocated > 0 and capital_to_be_allocated >= capital_invested_per_company:
+                stage.append(self.market.stage_ids[stage_invested])
+                valuation.append(self.stage_valuations[stage_invested])
+                invested.append(capital_invested_per_company)
+                ownership.append(capital_invested_per_company/self.stage_valuations[stage_invested])
+                capital_to_be_allocated -= capital_invested_per_company
+                primary_capital_deployed += capital_invested_per_company
+        return stage, valuation, invested, ownership, primary_capital_deployed
+
+    def build_scenario_arrays(self, num_scenarios):
+        ''' Build the starting portfolio once and broadcast it to every scenario'''
+        return ScenarioArrays(num_scenarios, *self.portfolio_template(), self.firm_attributes['follow_on_reserve'], self.firm_attributes['firm_lifespan_periods'])
+
+    def simulate_vectorized(self, arrays, draws, trajectories=None):
+        ''' Vectorized equivalent of simulate(): each period draws one uniform per company per scenario in a single batch, and applies M&A, fail, and promote as masked array updates.
+        Extra investments (primary checks recycled from unused reserve) are simulated in the same pass: every scenario starts with as many extra slots as the
+        whole reserve could fund, slots that no scenario can afford anymore are dropped as the reserve is deployed, and at the end each scenario keeps the
+        slots its unused reserve actually pays for.'''
+        extra_investment_type = self.firm_attributes['primary_investments'][0]
+        extras = self.build_extra_slots(len(arrays), self.max_extra_investments(arrays))
+
+        ## Which extra slots are funded is only known at the end, so their trajectory is kept per slot until then, in the recorder's int8 / float32
+        extra_history = []
+        if trajectories is not None:
+            trajectories.record(0, arrays)
+            extra_history.append((extras.state.copy(), np.multiply(extras.valuation, extras.firm_ownership, dtype=np.float32)))
+        for period in range(self.firm_attributes['firm_lifespan_periods']):
+            self.step_period(arrays, draws, period)
+            if extras.stage.shape[1] > 0:
+                self.step_period(extras, draws, period, extra=True)
+                extras.truncate_companies(self.max_extra_investments(arrays))
+            if trajectories is not None:
+                trajectories.record(period + 1, arrays)
+                extra_history.append((extras.state.copy(), np.multiply(extras.valuation, extras.firm_ownership, dtype=np.float32)))
+
+        ## If we didn't use all of our pro rata b/c our portfolio didn't do well, deploy remaining capital as primary investments
+        remaining = arrays.get_remaining_follow_on_capital()
+        num_extra_investments = np.where(remaining > 0, np.floor_divide(remaining, extra_investment_type[1]), 0).astype(np.int64)
+        funded = np.arange(extras.stage.shape[1])[None, :] < num_extra_investments[:, None]
+        if trajectories is not None:
+            ## Slots dropped along the way were never funded
+            num_slots = funded.shape[1]
+            for period, (state, value) in enumerate(extra_history):
+                trajectories.record_extras(period, state[:, :num_slots], value[:, :num_slots], funded)
+
+        extra_value = np.where(funded, extras.valuation * extras.firm_ownership, 0)
+        arrays.extra_alive_value += np.where(extras.state == ALIVE, extra_value, 0).sum(axis=1)
+        arrays.extra_acquired_value += np.where(extras.state == ACQUIRED, extra_value, 0).sum(axis=1)
+        arrays.extra_exit_proceeds += extras.acquisition_proceeds(funded)
+
+        arrays.num_extra_investments = num_extra_investments
+        arrays.primary_capital_deployed += num_extra_investments * extra_investment_type[1]
+        arrays.follow_on_reserve -= num_extra_investments * extra_investment_type[1]
+        if trajectories is not None:
+            trajectories.record_paid_in(slice(None), arrays.primary_capital_deployed, arrays.follow_on_by_period)
+
+    def max_extra_investments(self, arrays):
+        ''' Most extra investments any scenario's unused reserve could still fund'''
+        remaining = arrays.get_remaining_follow_on_capital()
+        if len(remaining) == 0:
+            return 0
+        return int(max(np.floor_divide(remaining.max(), self.firm_attributes['primary_investments'][0][1]), 0))
+
+    def build_extra_slots(self, num_scenarios, num_slots):
+        ''' num_slots extra investments per scenario, all alive at the entry stage. They get no pro rata b/c they come out of the reserve themselves.'''
+        extra_investment_type = self.firm_attributes['primary_investments'][0]
+        extra_stage = self.market.stage_ids[extra_investment_type[0]]
+        extra_valuation = self.stage_valuations[extra_investment_type[0]]
+        return ScenarioArrays(num_scenarios,
+                              [extra_stage]*num_slots,
+                              [extra_valuation]*num_slots,
+                              [extra_investment_type[1]]*num_slots,
+                              [extra_investment_type[1]/extra_valuation]*num_slots,
+                              0, 0, self.firm_attributes['firm_lifespan_periods'])
+
+    def step_period(self, arrays, draws, period, extra=False):
+        ''' Age every company in every scenario by one period. Only the live companies (alive and below the last stage) are gathered, as a flat list in
+        scenario then portfolio order, and written back, so failed, acquired and last-stage companies and scenarios with nothing left alive cost no work.'''
+        market = self.market
+        kind = 'extra_' if extra else ''
+
+        ## Companies at the last stage just stay alive
+        scenario, company = np.nonzero((arrays.state == ALIVE) & (arrays.stage < market.last_stage))
+        if len(scenario) == 0:
+            return
+        stage = arrays.stage[scenario, company]
+        rand = draws.uniforms_at(kind + 'decision', period, arrays.stage.shape, scenario, company)
+        m_and_a = rand < market.m_and_a_threshold_array[stage]
+        fail = ~m_and_a & (rand < market.fail_threshold_array[stage])
+        promote = ~m_and_a & ~fail
+
+        ## M&A: pick an exit multiplier for every acquisition at once
+        acquired = (scenario[m_and_a], company[m_and_a])
+        arrays.valuation[acquired] *= market.exit_multiples.sample(draws.uniforms_at(kind + 'm_and_a', period, arrays.stage.shape, *acquired))
+        arrays.state[acquired] = ACQUIRED
+        arrays.exit_period[acquired] = period
+
+        ## Fail
+        failed = (scenario[fail], company[fail])
+        arrays.valuation[failed] = 0
+        arrays.state[failed] = FAILED
+        arrays.exit_period[failed] = period
+
+        ## Promote to the next stage
+        scenario, company = scenario[promote], company[promote]
+        new_stage = stage[promote] + 1
+        new_valuation = market.valuation_array[new_stage]
+        ownership = arrays.firm_ownership[scenario, company]
+        post_dilution_ownership = ownership*(1-market.dilution_array[new_stage])
+        arrays.stage[scenario, company] = new_stage
+        arrays.valuation[scenario, company] = new_valuation
+        arrays.firm_ownership[scenario, company] = post_dilution_ownership
+
+        # No secondary capital available b/c this is the "extra" batch of companies, so their stakes just dilute
+        if extra:
+            return
+
+        ## Split the follow-on reserve between the pro rata asks with the firm's policy. The asks are packed into one row per asking scenario, in portfolio order.
+        asks = new_valuation <= self.firm_attributes['pro_rata_at_or_below']
+        if not asks.any():
+            return
+        scenario, company, new_valuation = scenario[asks], company[asks], new_valuation[asks]
+        rows, first, counts = np.unique(scenario, return_index=True, return_counts=True)
+        row = np.repeat(np.arange(len(rows)), counts)
+        column = np.arange(len(scenario)) - np.repeat(first, counts)
+        desired = np.zeros((len(rows), counts.max()))
+        desired[row, column] = (ownership - post_dilution_ownership)[asks]*new_valuation
+        valuation = np.zeros(desired.shape)
+        valuation[row, column] = new_valuation
+        pro_rata_investment = follow_on_policies[self.follow_on_policy](desired, arrays.get_remaining_follow_on_capital()[rows], valuation)
+
+        invested = pro_rata_investment[row, column]
+        arrays.firm_invested_capital[scenario, company] += invested
+        arrays.firm_ownership[scenario, company] += invested/new_valuation
+        arrays.follow_on_capital_deployed[rows] += pro_rata_investment.sum(axis=1)
+        arrays.follow_on_by_period[rows, period] += pro_rata_investment.sum(axis=1)
+
+
+    ################################################################################################################################################################################################
+    ############################################# Exact engine: convolve per-company outcome distributions instead of sampling, when the companies are independent #################################
+    ################################################################################################################################################################################################
+    def exact_company_outcomes(self):
+        ''' Terminal outcome distribution (probability, value, follow-on) of each distinct starting position in the portfolio, with how many companies share it.
+        An empty reserve never pays pro rata, so the stakes just dilute.'''
+        stage, valuation, invested, ownership, primary_capital_deployed = self.portfolio_template()
+        pro_rata_at_or_below = self.firm_attributes['pro_rata_at_or_below'] if self.firm_attributes['follow_on_reserve'] > 0 else -math.inf
+        return {position: (count, self.market.terminal_outcomes(*position, self.firm_attributes['firm_lifespan_periods'], pro_rata_at_or_below))
+                for position, count in Counter(zip(stage, ownership)).items()}
+
+    def exact_engine_blocker(self):
+        ''' None if the exact engine applies, otherwise why not. Companies only interact through the shared follow-on reserve: if every company taking
+        every pro rata it could would still fit in the reserve, no allocation is ever cut short and the companies' fates are independent.
+        Each company's outcomes are enumerated, so the exit multiples have to be a discrete table.'''
+        if not self.market.exit_multiples.discrete:
+            return 'exit multiples follow a continuous distribution'
+        max_follow_on = sum(count*follow_on.max() for count, (probability, value, follow_on) in self.exact_company_outcomes().values())
+        if max_follow_on > self.firm_attributes['follow_on_reserve'] + 1e-9:
+            return f"up to {max_follow_on:.1f} of pro rata can be called on a follow-on reserve of {self.firm_attributes['follow_on_reserve']}"
+        return None
+
+    def simulate_exact(self, value_bins=4096, follow_on_subdivisions=4, value_spread=12):
+        ''' Full MoM distribution with no sampling. Each company's joint distribution of (follow-on invested, value) is laid on a grid and transformed
+        once; the portfolio's spectrum is the product of the companies' spectra, each raised to the number of companies that share it. Unused reserve buys
+        extra investments as in simulate(), so for every level of follow-on invested, that many extra companies are added to the value spectrum before the
+        single inverse transform, and the value is divided by the capital invested.
+        Follow-on amounts and the extra investments' check usually share a step (0.3 for 0.6 of pro rata on 1.5 checks); on that grid every follow-on
+        total, and so every extras count, is exact. When they do not, or that grid would be more than 4x finer, follow-on is split linearly across bins of
+        1/follow_on_subdivisions of a check. That keeps mean follow-on exact but not the extras count, which is a step function of it: an outcome's invested
+        capital can then be off by up to one check, and Mean Invested is biased by a fraction of that (0.1 on a 200 fund with 1.5 checks at 4 subdivisions).
+        The value grid reaches value_spread standard deviations above the mean of the largest possible portfolio; the rare outcomes beyond it are counted at
+        its top (result.tail_probability). MoM is rounded to 0.1x like the simulated engines.'''
+        stage, valuation, invested, ownership, primary_capital_deployed = self.portfolio_template()
+        company_outcomes = self.exact_company_outcomes()
+        reserve = self.firm_attributes['follow_on_reserve']
+        num_periods = self.firm_attributes['firm_lifespan_periods']
+
+        extra_investment_type = self.firm_attributes['primary_investments'][0]
+        extra_stage = self.market.stage_ids[extra_investment_type[0]]
+        extra_probability, extra_value, extra_follow_on = self.market.terminal_outcomes(extra_stage, extra_investment_type[1]/self.stage_valuations[extra_investment_type[0]], num_periods)
+        max_extra_investments = int(reserve // extra_investment_type[1]) if reserve > 0 else 0
+
+        ## Size the value grid from the largest portfolio that can be held
+        distributions = [(count, probability, value) for count, (probability, value, follow_on) in company_outcomes.values()] + [(max_extra_investments, extra_probability, extra_value)]
+        mean = sum(count*np.dot(probability, value) for count, probability, value in distributions)
+        variance = sum(count*(np.dot(probability, value**2) - np.dot(probability, value)**2) for count, probability, value in distributions)
+        largest = sum(count*value.max() for count, probability, value in distributions)
+        value_width = min(largest, mean + value_spread*math.sqrt(variance))/(value_bins - 1)
+
+        ## Every follow-on total the portfolio can reach fits on the follow-on axis, and the value axis has room for twice its grid, so the
+        ## circular FFT never wraps mass that matters around
+        def follow_on_grid(width):
+            nodes = {position: int(math.ceil(follow_on.max()/width - 1e-9)) + 1 for position, (count, (probability, value, follow_on)) in company_outcomes.items()}
+            return nodes, sum(count*(nodes[position] - 1) for position, (count, outcomes) in company_outcomes.items()) + 1
+
+        follow_on_width = extra_investment_type[1]/follow_on_subdivisions
+        follow_on_nodes, follow_on_size = follow_on_grid(follow_on_width)
+        step = common_step(np.concatenate([follow_on for probability, value, follow_on in (outcomes for count, outcomes in company_outcomes.values())] + [[extra_investment_type[1]]]))
+        if step is not None:
+            step_nodes, step_size = follow_on_grid(step)
+            if step_size <= 4*follow_on_size:
+                follow_on_width, follow_on_nodes, follow_on_size = step, step_nodes, step_size
+        fft_shape = (1 << (follow_on_size - 1).bit_length(), 1 << (2*value_bins - 1).bit_length())
+
+        spectrum = np.ones((fft_shape[0], fft_shape[1]//2 + 1), dtype=np.complex128)
+        for position, (count, (probability, value, follow_on)) in company_outcomes.items():
+            company = lattice_distribution(np.column_stack([follow_on, value]), probability, (follow_on_width, value_width), (follow_on_nodes[position], value_bins))
+            spectrum *= np.fft.rfftn(company, fft_shape)**count
+
+        ## Back to follow-on levels (still value spectra), where each level's extra investments are added before transforming the values back
+        follow_on_invested = np.arange(follow_on_size)*follow_on_width
+        remaining = reserve - follow_on_invested
+        num_extra_investments = np.where(remaining > 0, np.floor(remaining/extra_investment_type[1] + 1e-9), 0).astype(np.int64)
+        extra_spectrum = np.fft.rfft(lattice_distribution(extra_value[:, None], extra_probability, (value_width,), (value_bins,)), fft_shape[1])
+        by_follow_on = np.fft.ifft(spectrum, axis=0)[:follow_on_size]*extra_spectrum**num_extra_investments[:, None]
+        total = np.maximum(np.fft.irfft(by_follow_on, fft_shape[1], axis=1), 0)
+
+        ## Values past the grid are counted at its top
+        total[:, value_bins - 1] += total[:, value_bins:].sum(axis=1)
+        total = total[:, :value_bins]
+        invested_capital = primary_capital_deployed + follow_on_invested + num_extra_investments*extra_investment_type[1]
+        values = np.arange(value_bins)*value_width
+        mom_index = np.rint(values[None, :]/invested_capital[:, None]*10).astype(np.int64)
+        mean_invested = float(np.dot(total.sum(axis=1), invested_capital))
+        tail_probability = float(total[:, -1].sum())
+
+        probability = np.bincount(mom_index.ravel(), weights=total.ravel())
+        support = np.flatnonzero(probability > 0)
+        self.result = DistributionResult(support/10, probability[support], self.num_scenarios, mean_invested, tail_probability)
+        return self.result
+
+
+    ################################################################################################################################################################################################
+    ################################################# Streaming: score each scenario as soon as it finishes, keep only mergeable accumulators ######################################################
+    ################################################################################################################################################################################################
+    def simulate_streaming(self, batch_size=1000, store_path=None, store_company_states=False):
+        ''' Simulate without retaining firm_scenarios. Scenarios are run batch_size at a time, their MoM, portfolio value and IRR are fed into
+        OutcomeAccumulators, and the batch is dropped, so memory stays flat no matter how many scenarios are run.
+        With store_path, every batch's outcomes (and, with store_company_states, each company's final state) are also written to a ResultStore
+        in that directory, which is reopened read-only as self.store once the run is done.'''
+        if self.engine == 'exact':
+            raise ValueError('The exact engine computes the whole distribution at once; use simulate()')
+        self.firm_scenarios = []
+        self.scenario_arrays = None
+        self.result = None
+        self.streaming_statistics = {'MoM': OutcomeAccumulator(), 'Value': OutcomeAccumulator(), 'IRR': OutcomeAccumulator(edges=histogram_edges(.05, 1, -1))}
+        num_portfolio_companies = len(self.portfolio_template()[0])
+
+        store = None
+        if store_path is not None:
+            store = ResultStore.create(store_path, self.num_scenarios, self.stages,
+                                       entry_stage=self.portfolio_template()[0] if store_company_states else None,
+                                       metadata={'firm_attributes': self.firm_attributes, 'engine': self.engine, 'seed': self.seed, 'sampling': self.sampling})
+
+        if self.engine == 'vectorized':
+            generator = self.generator()
+        else:
+            rng = self.python_random()
+
+        for batch, start in enumerate(range(0, self.num_scenarios, batch_size)):
+            size = min(batch_size, self.num_scenarios - start)
+            if self.engine == 'vectorized':
+                arrays = self.build_scenario_arrays(size)
+                self.simulate_vectorized(arrays, self.random_draws(generator, (batch,), start))
+                batch_result = SimulationResult.from_scenario_arrays(arrays, self.cash_flow_years())
+            else:
+                firms = [self.build_firm(start + i) for i in range(size)]
+                for firm in firms:
+                    self.simulate_firm(firm, rng)
+                batch_result = SimulationResult.from_firms(firms, self.cash_flow_years())
+                if store_company_states:
+                    arrays = ScenarioArrays.from_firms(firms, num_portfolio_companies, self.firm_attributes['firm_lifespan_periods'])
+            for type, accumulator in self.streaming_statistics.items():
+                accumulator.update(batch_result.outcomes[type])
+            if store is not None:
+                store.write(start, batch_result.outcomes, arrays if store_company_states else None)
+
+        if store is not None:
+            store.close()
+            self.store = ResultStore.open(store_path)
+
+    ################################################################################################################################################################################################
+    ####################################################### Adaptive: keep adding batches of scenarios until the percentiles are precise enough ####################################################
+    ################################################################################################################################################################################################
+    def simulate_adaptive(self, tolerance=.05, batch_size=1000, max_scenarios=100000, percentiles=(50, 75, 90, 95), confidence=0.95):
+        ''' Simulate batch_size scenarios at a time. After each batch, compute a confidence interval for every percentile reported by
+        performance_quartiles (the 25th is always included) and stop once every interval's half-width is within tolerance (in MoM, e.g. 0.05x)
+        or max_scenarios have been run. self.num_scenarios is set to the number of scenarios actually used, and self.precision records the
+        intervals reached and whether the tolerance was met.'''
+        if self.engine == 'exact':
+            raise ValueError('The exact engine computes the whole distribution at once; use simulate()')
+        self.firm_scenarios = []
+        self.streaming_statistics = None
+        percentiles = sorted(set(percentiles) | {25})
+
+        if self.engine == 'vectorized':
+            generator = self.generator()
+            batches = []
+        else:
+            rng = self.python_random()
+
+        mom = np.empty(0)
+        converged = False
+        batch = 0
+        while len(mom) < max_scenarios and not converged:
+            size = min(batch_size, max_scenarios - len(mom))
+            if self.engine == 'vectorized':
+                arrays = self.build_scenario_arrays(size)
+                self.simulate_vectorized(arrays, self.random_draws(generator, (batch,), len(mom)))
+                batches.append(arrays)
+                batch_mom = arrays.get_MoM()
+            else:
+                batch_mom = np.empty(size)
+                for i in range(size):
+                    firm = self.build_firm(len(mom) + i)
+                    self.simulate_firm(firm, rng)
+                    self.firm_scenarios.append(firm)
+                    batch_mom[i] = firm.get_MoM()
+            mom = np.concatenate([mom, batch_mom])
+            batch += 1
+
+            sorted_mom = np.sort(mom)
+            intervals = {p: quantile_confidence_interval(sorted_mom, p, confidence) for p in percentiles}
+            half_widths = {p: (upper - lower)/2 for p, (lower, upper) in intervals.items()}
+            ## MoM is rounded to 0.1x, so half-widths come in steps of 0.05x; allow for float error in that step
+            converged = max(half_widths.values()) <= tolerance + 1e-9
+
+        self.num_scenarios = len(mom)
+        if self.engine == 'vectorized':
+            self.scenario_arrays = ScenarioArrays.concatenate(batches)
+            self.result = SimulationResult.from_scenario_arrays(self.scenario_arrays, self.cash_flow_years())
+        else:
+            self.result = SimulationResult.from_firms(self.firm_scenarios, self.cash_flow_years())
+        self.precision = {
+            'Scenarios used': self.num_scenarios,
+            'Converged': converged,
+            'Tolerance': tolerance,
+            'Confidence': confidence,
+            'Confidence intervals': intervals,
+            'Half widths': half_widths
+        }
+        return self.precision
+
+    ################################################################################################################################################################################################
+    ######################################## Control variate: portfolio value without follow-ons, whose expectation is known exactly from the stage Markov chain ##################################
+    ################################################################################################################################################################################################
+    def expected_control_value(self):
+        ''' Exact expected value of the primary portfolio if the firm never followed on'''
+        stage, valuation, invested, ownership, primary_capital_deployed = self.portfolio_template()
+        num_periods = self.firm_attributes['firm_lifespan_periods']
+        return sum(self.market.expected_terminal_value(stage_id, stake, num_periods) for stage_id, stake in zip(stage, ownership))
+
+    def control_values(self):
+        ''' Per-scenario value of the primary portfolio with each company's final valuation but no follow-on ownership. Companies only move
+        forward one stage at a time, so the no-follow-on ownership follows from the final stage alone.'''
+        arrays = self.scenario_arrays
+        if arrays is None:
+            arrays = ScenarioArrays.from_firms(self.firm_scenarios, len(self.portfolio_template()[0]), self.firm_attributes['firm_lifespan_periods'])
+        stage, valuation, invested, ownership, primary_capital_deployed = self.portfolio_template()
+        start_retention = self.market.cumulative_retention[np.asarray(stage, dtype=np.int64)]
+        ownership_without_follow_on = np.asarray(ownership)[None, :]*self.market.cumulative_retention[arrays.stage]/start_retention[None, :]
+        return (arrays.valuation*ownership_without_follow_on).sum(axis=1)
+
+    def control_variate_estimates(self, percentiles=(25, 50, 75, 90, 95)):
+        ''' Mean MoM and MoM percentiles corrected with the no-follow-on portfolio value as a control variate, plus the variance reduction achieved'''
+        if self.result is None or isinstance(self.result, DistributionResult):
+            print('ERROR: ' + 'control variates need the per-scenario outcomes of simulate() or simulate_parallel()')
+            return None
+        self.control_variate = control_variate_estimate(self.result.mom, self.control_values(), self.expected_control_value(), percentiles)
+        return self.control_variate
+
+    def replay_scenario(self, index):
+        ''' Regenerate scenario index of a sampling='counter' run on its own, in constant time, with every company's path. Returns the scenario as
+        one-row ScenarioArrays (its final portfolio, e.g. for scenario_repr) and a TrajectoryRecorder holding each company's stage, state and value
+        in every period. Large runs can then keep only aggregates (simulate_streaming) and rebuild any outlier on demand.
+        The seed has to be reproducible (an int or a SeedSequence).'''
+        if self.sampling != 'counter':
+            raise ValueError("Replaying a scenario needs sampling='counter'")
+        if not 0 <= index < self.num_scenarios:
+            raise IndexError('Scenario ' + str(index) + ' is not in this run of ' + str(self.num_scenarios))
+        arrays = self.build_scenario_arrays(1)
+        trajectories = TrajectoryRecorder(1, arrays.stage.shape[1], self.firm_attributes['firm_lifespan_periods'])
+        self.simulate_vectorized(arrays, CounterDraws(self.counter_key(), self.scenario_offset + index), trajectories)
+        return arrays, trajectories
+
+    def simulate_parallel(self, max_workers=None, shard_size=10000, streaming=False):
+        ''' Split the scenarios into shards of shard_size and simulate them on a process pool.
+        Shard i always draws from the i-th child of the root seed, so the outcomes only depend on the seed and shard_size, not on how many workers ran.
+        With counter-based draws every shard uses the root seed and its scenarios' indices in the whole run, so they don't even depend on shard_size.'''
+        if self.engine == 'exact':
+            raise ValueError('The exact engine computes the whole distribution at once; use simulate()')
+        max_workers = max_workers or os.cpu_count()
+        shard_sizes = [min(shard_size, self.num_scenarios - start) for start in range(0, self.num_scenarios, shard_size)]
+        shard_starts = list(range(0, self.num_scenarios, shard_size))
+        if self.sampling == 'counter':
+            shard_seeds = [self.seed_sequence()]*len(shard_sizes)
+        else:
+            shard_seeds = self.seed_sequence().spawn(len(shard_sizes))
+
+        shard_args = [(size, self.stages, self.stage_probs, self.stage_valuations, self.stage_dilution, self.firm_attributes, self.engine, shard_seed, streaming,
+                       self.common_random_numbers, self.sampling, self.follow_on_policy, self.market.exit_multiples, start)
+                      for size, shard_seed, start in zip(shard_sizes, shard_seeds, shard_starts)]
+        if max_workers == 1 or len(shard_args) == 1:
+            shards = [simulate_shard(*args) for args in shard_args]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                shards = list(executor.map(simulate_shard, *zip(*shard_args)))
+
+        ## Merge the shards back into a single result, in shard order
+        self.firm_scenarios = []
+        if streaming:
+            self.scenario_arrays = None
+            self.result = None
+            self.streaming_statistics = shards[0]
+            for shard in shards[1:]:
+                for key in self.streaming_statistics:
+                    self.streaming_statistics[key].merge(shard[key])
+            return
+        self.scenario_arrays = ScenarioArrays.concatenate(shards)
+        self.result = SimulationResult.from_scenario_arrays(self.scenario_arrays, self.cash_flow_years())
 
 
     def get_IRR_return_outcomes(self):
-        print('ERROR: ' + 'IRR not implemented')
+        if self.streaming_statistics is not None:
+            print('ERROR: ' + 'individual outcomes are not kept by simulate_streaming')
+            return None
+        if isinstance(self.result, DistributionResult):
+            print('ERROR: ' + 'the exact engine only computes the MoM distribution')
+            return None
+        return self.result.outcomes['IRR'].tolist()
 
     def get_MoM_return_outcomes(self):
-        outcomes = []
-        for firm in self.firm_scenarios:
-            outcomes.append(firm.get_MoM())
-        return outcomes
+        if self.streaming_statistics is not None:
+            print('ERROR: ' + 'individual outcomes are not kept by simulate_streaming')
+            return None
+        if isinstance(self.result, DistributionResult):
+            print('ERROR: ' + 'the exact engine computes a distribution, not individual outcomes')
+            return None
+        return self.result.mom.tolist()
     
     def get_median_return_outcome(self, type):
-        outcomes = []
-        if type == 'MoM':
-            outcomes = self.get_MoM_return_outcomes()
-        elif type == 'IRR':
-            outcomes = self.get_IRR_return_outcomes()
-        if len(outcomes) % 2 == 0:
-            return (outcomes[len(outcomes)//2] + outcomes[len(outcomes)//2 - 1])/2
-        else:
-            return outcomes[len(outcomes)//2]
+        if self.streaming_statistics is not None:
+            return self.streaming_statistics[type].percentile(50)
+        if type == 'IRR' and isinstance(self.result, DistributionResult):
+            print('ERROR: ' + 'the exact engine only computes the MoM distribution')
+            return None
+        return self.result.median(type)
 
     def get_exact_return_outcomes(self):
-        outcomes = []
-        for firm in self.firm_scenarios:
-            outcomes.append(firm.concise_portfolio_value())
-        return outcomes
+        if self.streaming_statistics is not None:
+            print('ERROR: ' + 'individual outcomes are not kept by simulate_streaming')
+            return None
+        if isinstance(self.result, DistributionResult):
+            print('ERROR: ' + 'the exact engine computes a distribution, not individual outcomes')
+            return None
+        return self.result.value.tolist()
 
     
-    def performance_quartiles(self):
+    def performance_quartiles(self, type='MoM'):
         
-        outcomes = self.get_MoM_return_outcomes()
         performance = {}
-        
-        performance['25'] = [str(np.percentile(outcomes, 25))]
-        performance['50'] = [str(np.percentile(outcomes, 50))]
-        performance['75'] = [str(np.percentile(outcomes, 75))]
-        performance['90'] = [str(np.percentile(outcomes, 90))]
-        performance['95'] = [str(np.percentile(outcomes, 95))]
+        if self.streaming_statistics is not None:
+            for percentile in [25, 50, 75, 90, 95]:
+                performance[str(percentile)] = [str(self.streaming_statistics[type].percentile(percentile))]
+            return performance
+        if type == 'IRR' and isinstance(self.result, DistributionResult):
+            print('ERROR: ' + 'the exact engine only computes the MoM distribution')
+            return None
+
+        performance['25'] = [str(self.result.percentile(25, type))]
+        performance['50'] = [str(self.result.percentile(50, type))]
+        performance['75'] = [str(self.result.percentile(75, type))]
+        performance['90'] = [str(self.result.percentile(90, type))]
+        performance['95'] = [str(self.result.percentile(95, type))]
 
         return performance
 
 
     
 
-    def montecarlo_histogram(self):
-        ''' Histogram for montecarlo simulation - very ugly code optimized for  being able to combine multiple hisograms across different simulations'''
-        
-        histogram = {}
-        outcomes = self.get_MoM_return_outcomes()
-        hist_size = .25
-        counter = 0.0
-        upper_limit = 15
-        while counter < upper_limit:
-            relevant = list(filter(lambda y: counter <= y < counter+hist_size, outcomes))
-            histogram[f"{counter}-{counter+hist_size}"] = [str(len(relevant))]
-            counter += hist_size
-        
-        return histogram
+    def montecarlo_histogram(self, edges=None):
+        ''' Histogram of MoM outcomes (0.25x-wide bins up to 15x by default, see histogram_edges), with underflow/overflow counts. Histograms with the same edges can be merged across simulations'''
+        if self.streaming_statistics is not None:
+            histogram = self.streaming_statistics['MoM'].histogram
+            if edges is not None and not np.array_equal(histogram.edges, edges):
+                print('ERROR: ' + 'a streamed simulation only has the histogram it was accumulated with')
+                return None
+            return histogram
+        return self.result.histogram(edges)
 
     
     def get_montecarlo_outcomes_overview(self):
@@ -417,6 +1601,17 @@ class Montecarlo:
 
     def print_results(self):
         print(f"Montecarlo Simulation Results ({self.num_scenarios} scenarios):")
+        if self.streaming_statistics is not None:
+            mom = self.streaming_statistics['MoM']
+            print(f"MoM mean {mom.mean:.2f}x, std {mom.std():.2f}x, min {mom.min}x, max {mom.max}x (individual scenarios not kept)")
+            return
+        if isinstance(self.result, DistributionResult):
+            print(f"MoM mean {self.result.mean():.2f}x, std {self.result.std():.2f}x (exact distribution, no individual scenarios)")
+            return
+        if self.scenario_arrays is not None:
+            for i in range(len(self.scenario_arrays)):
+                print(f"Scenario {i+1}: {self.scenario_arrays.scenario_repr(i, self.stages)}")
+            return
         for i, scenario in enumerate(self.firm_scenarios, start=1):
             print(f"Scenario {i}: {scenario}")
             
@@ -468,13 +1663,14 @@ lifespan_years = 11
 num_scenarios = 1000
 
 
-def build_firm_attributes_for_simulation(pre_seed_percentage, pre_seed_investment_amount, seed_percentage, seed_investment_amount, primary, follow_on, total_fund_size, pro_rata_at_or_below):
-    
+def build_firm_attributes_for_simulation(pre_seed_percentage, pre_seed_investment_amount, seed_percentage, seed_investment_amount, primary, follow_on, total_fund_size, pro_rata_at_or_below, market_valuations=None):
+    ## market_valuations: the stage valuations the pro rata cutoff is looked up in, when simulating a market other than the built-in one
+    market_valuations = stage_valuations if market_valuations is None else market_valuations
     attributes = {
         'primary_investments': [], ## round, invested capital, total capital allocated to this stage
         'follow_on_reserve':follow_on, ## total dollars reserved for fdund size
         'fund_size': total_fund_size,
-        'pro_rata_at_or_below': stage_valuations[pro_rata_at_or_below],
+        'pro_rata_at_or_below': market_valuations[pro_rata_at_or_below],
         'firm_lifespan_periods': lifespan_periods,
         'firm_lifespan_years': lifespan_years
     }
@@ -519,6 +1715,24 @@ def build_firm_attributes_for_simulation(pre_seed_percentage, pre_seed_investmen
 
 
 
+def helper_combine(simulations, edges=None):
+    ''' Line up the MoM histograms of several simulations (Montecarlo objects or Histograms with the same edges), one column per simulation'''
+    histograms = [simulation if isinstance(simulation, Histogram) else simulation.montecarlo_histogram(edges) for simulation in simulations]
+    combined = {label: [] for label in histograms[0].labels()}
+    combined['overflow'] = []
+    for histogram in histograms:
+        if not np.array_equal(histogram.edges, histograms[0].edges):
+            raise ValueError('Cannot combine histograms with different bin edges')
+        for label, count in zip(histogram.labels(), histogram.counts):
+            combined[label].append(int(count))
+        combined['overflow'].append(histogram.overflow)
+
+    for label, counts in combined.items():
+        print(label, *counts, sep='\t')
+    return combined
+
+
+
 def run_montecarlo(firm_attributes):
     ''' Run a montecarlo simulation with a specified set of firm attributes'''
 
@@ -544,6 +1758,60 @@ def run_montecarlo(firm_attributes):
 
 
 
+def simulate_sweep_point(point, num_scenarios, seed, engine):
+    ''' Run a single grid point of sweep() (in a worker process) and return its summary row'''
+    firm_attributes = build_firm_attributes_for_simulation(point['pre_seed_percentage'], point['pre_seed_investment_amount'],
+                                                           point['seed_percentage'], point['seed_investment_amount'],
+                                                           point['primary'], point['follow_on'], point['total_fund_size'],
+                                                           point['pro_rata_at_or_below'])
+    if firm_attributes is None:
+        return {**point, 'Error': 'invalid firm attributes'}
+
+    montecarlo = Montecarlo(num_scenarios, stages, stage_probs, stage_valuations, stage_dilution, firm_attributes,
+                            engine=engine, seed=seed, common_random_numbers=(engine == 'vectorized'))
+    montecarlo.initialize_scenarios()
+    montecarlo.simulate()
+    return {**point, **montecarlo.result.summary()}
+
+
+def complete_sweep_point(base, overrides):
+    ''' base with overrides applied. If overrides change pre_seed_percentage without seed_percentage, the seed share is set to the rest;
+    if they change primary or total_fund_size without follow_on, the reserve is set to the rest of the fund.'''
+    point = {**base, **overrides}
+    if 'pre_seed_percentage' in overrides and 'seed_percentage' not in overrides:
+        point['seed_percentage'] = 1 - point['pre_seed_percentage']
+    if ('primary' in overrides or 'total_fund_size' in overrides) and 'follow_on' not in overrides:
+        point['follow_on'] = point['total_fund_size'] - point['primary']
+    return point
+
+
+def sweep(base, grid, num_scenarios=num_scenarios, seed=None, max_workers=None, engine='vectorized'):
+    ''' Run a grid of fund configurations and return one tidy DataFrame row of statistics per configuration.
+
+    base holds the build_firm_attributes_for_simulation arguments by name (pre_seed_percentage, pre_seed_investment_amount, seed_percentage,
+    seed_investment_amount, primary, follow_on, total_fund_size, pro_rata_at_or_below). grid is either a dict of argument -> list of values
+    (every combination is run) or a list of dicts of overrides. If a point changes pre_seed_percentage without seed_percentage, the seed
+    share is set to the rest; if it changes primary or total_fund_size without follow_on, the reserve is set to the rest of the fund.
+
+    Every point uses the same seed with common random numbers, so differences between rows reflect the configurations rather than sampling noise.
+    Points run in parallel on a process pool.'''
+    if isinstance(grid, dict):
+        grid = [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+
+    seed = np.random.SeedSequence().entropy if seed is None else seed
+    points = [complete_sweep_point(base, overrides) for overrides in grid]
+
+    max_workers = max_workers or os.cpu_count()
+    args = [(point, num_scenarios, seed, engine) for point in points]
+    if max_workers == 1 or len(points) == 1:
+        rows = [simulate_sweep_point(*arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            rows = list(executor.map(simulate_sweep_point, *zip(*args)))
+    return pd.DataFrame(rows)
+
+
+
 if __name__ == '__main__':
     print('\n')
 
@@ -617,119 +1885,19 @@ if __name__ == '__main__':
     # }
     
 
-    # stage_splits = [(1.0, 0), (.9, .1), (.8, .2), (.7, .3), (.6, .4), (.5, .5), (.4, .6), (.3, .7), (.2, .8), (.1, .9), (0, 1.0)]
-    # stage_investments = (1.5, 4)
-    
-    # outcomes = []
-    # for split in stage_splits:
-    #     fs = 200
-    #     reserve = 50
-    #     pro_rata_at_or_below = 70
-    #     print('Split:', 'Pre-seed', split[0], 'Seed', split[1])
-    #     pre_seed_capital = split[0]*(fs-reserve)
-    #     seed_capital = split[1]*(fs-reserve)
-    #     num_seed_invesments = seed_capital // stage_investments[1]
-    #     num_pre_seed_investments = pre_seed_capital // stage_investments[0]
-    #     extra = (fs-reserve)-num_pre_seed_investments*stage_investments[0]-num_seed_invesments*stage_investments[1]
-    #     reserve += extra
-
-    #     print('Pre-seed:', num_pre_seed_investments*stage_investments[0], 'Seed:', num_seed_invesments*stage_investments[1], 'Extra:', extra)
-
-    #     firm_attributes_mold['primary_investments'] = [['Seed', stage_investments[1], num_seed_invesments*stage_investments[1]], ['Pre-seed', stage_investments[0], num_pre_seed_investments*stage_investments[0]]]
-    #     firm_attributes_mold['follow_on_reserve'] = reserve
-    #     firm_attributes_mold['pro_rata_at_or_below'] = pro_rata_at_or_below
-    #     firm_attributes_mold['fund_size'] = fs
-    #     outcomes.append(run_montecarlo(firm_attributes_mold))
-    # helper_combine(outcomes)
-
-    
-    #----------------------------------------------------
-    #----------------------------------------------------
-    # outcomes = []
-    # fs = 200
-    # reserve = 50
-    # up_to_valuation = 70
-    # pre_seed_percent = .1
-    # seed_percent = .9
-    # pre_seed_investment = 1.5
-    # seed_investment = 4
-    # # print('here1')
-    # for x in [.25, .5, .75, 1, 1.25, 1.5, 1.75, 2, 2.25]:
-        
-    #     # print('status:', (fs)//x, ((fs)//x)*x, x)
-    #     # print('here2')
-    #     primary_avaliable = fs-reserve
-    #     pre_seed_capital = math.floor(pre_seed_percent*primary_avaliable)
-    #     seed_capital = math.floor(seed_percent*primary_avaliable)
-    #     psi = pre_seed_investment*x
-    #     si = seed_investment*x
-
-    #     firm_attributes_mold['primary_investments'] = [['Seed', si, seed_capital], ['Pre-seed', psi, pre_seed_capital]]
-    #     firm_attributes_mold['fund_size'] = fs
-    #     firm_attributes_mold['follow_on_reserve'] = fs - seed_capital-pre_seed_capital
-    #     outcomes.append(run_montecarlo(firm_attributes_mold))
-    
-    # helper_combine(outcomes)
-    #---------------------------------------------------
-    #---------------------------------------------------
-
-
-    # outcomes = []
-    # fs = 200
-    # reserve = 50
-    # up_to_valuation = 70
-    # for x in [i/4 for i in range(4,31)]:
-    #     print('status:', (fs-reserve)//x, ((fs-reserve)//x)*x, x)
-    #     to_be_deployed = ((fs-reserve)//x)*x
-    #     firm_attributes_mold['primary_investments'] = [['Seed', x, to_be_deployed]]
-    #     firm_attributes_mold['fund_size'] = fs
-    #     firm_attributes_mold['pro_rata_at_or_below'] = up_to_valuation
-    #     firm_attributes_mold['follow_on_reserve'] = fs - to_be_deployed
-    #     outcomes.append(run_montecarlo(firm_attributes_mold))
-    # helper_combine(outcomes)
-
-
-    # outcomes = []
-    # for x in [2500, 5000, 7500, 10000, 12500, 15000]:
-    #     fs = 200
-    #     reserve = 50
-    #     firm_attributes_mold['primary_investments'] = [['Seed', 4, 150]]
-    #     firm_attributes_mold['fund_size'] = 200
-    #     firm_attributes_mold['follow_on_reserve'] = 50
-    #     firm_attributes_mold['pro_rata_at_or_below'] = 70
-    #     outcomes.append(run_montecarlo(firm_attributes_mold, x))
-    # helper_combine(outcomes)
-
-
-    # outcomes = []
-    
-    # for z in [.1, .2]:
-    # for y in [30, 70, 200, 500]:
-    #     for x in [0,40, 50, 60]:
-    #         fs = 200
-    #         reserve = x
-    #         up_to_valuation = y
-    #         amount_invested = (1.5, 4)
-
-    #         seed_capital = ((1-.1)*(fs-reserve)//amount_invested[1])*amount_invested[1]
-    #         pre_seed_capital = (.1*(fs-reserve)//amount_invested[0])*amount_invested[0]
-    #         amount_deployed = seed_capital + pre_seed_capital
-    #         actual_reserve = fs - amount_deployed
-    #         print('ammount deployed', amount_deployed, 'actual reserve', actual_reserve)    
-
-
-    #         firm_attributes_mold['primary_investments'] = [['Seed', amount_invested[1],seed_capital ], ['Pre-seed', amount_invested[0], pre_seed_capital]]
-    #         firm_attributes_mold['fund_size'] = 200
-    #         firm_attributes_mold['follow_on_reserve'] = actual_reserve
-    #         firm_attributes_mold['pro_rata_at_or_below'] = up_to_valuation
-    #         print('pre_seed_capital:', pre_seed_capital, 'seed_capital:', seed_capital, 'actual_reserve:', actual_reserve)
-    #         outcomes.append(run_montecarlo(firm_attributes_mold))
-    # helper_combine(outcomes)
-
-
-    
-
+    ## The hand-written grid loops that used to live here are now sweep() calls, e.g.:
+    # base = {'pre_seed_percentage': .1, 'pre_seed_investment_amount': 1.5, 'seed_percentage': .9, 'seed_investment_amount': 4,
+    #         'primary': 150, 'follow_on': 50, 'total_fund_size': 200, 'pro_rata_at_or_below': 'Series A'}
 
+    ## Pre-seed / seed split
+    # print(sweep(base, {'pre_seed_percentage': [i/10 for i in range(0, 11)]}))
 
+    ## Check size multiplier
+    # print(sweep(base, [{'pre_seed_investment_amount': 1.5*x, 'seed_investment_amount': 4*x} for x in [.25, .5, .75, 1, 1.25, 1.5, 1.75, 2, 2.25]]))
 
+    ## Reserve size x pro rata cutoff
+    # print(sweep(base, {'primary': [200, 160, 150, 140], 'pro_rata_at_or_below': ['Seed', 'Series A', 'Series B', 'Series C']}))
 
+    ## Scenario counts
+    # for x in [2500, 5000, 7500, 10000, 12500, 15000]:
+    #     print(sweep(base, [{}], num_scenarios=x))
@@ -0,0 +1,493 @@
+import math
+import itertools
+import numpy as np
+from fractions import Fraction
+from statistics import NormalDist
+
+
+#############################################################################
+#############################################################################
+######################### QUANTILE SKETCH CLASS #############################
+#############################################################################
+#############################################################################
+class QuantileSketch:
+    ''' KLL quantile sketch. Keeps a stack of compactors, where an item at level h stands in for 2^h original samples.
+    Memory is O(k log n) no matter how many samples are added, and two sketches can be merged by stacking their levels.'''
+
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.compactors = [np.empty(0)]
+        self.count = 0
+
+        ## Picks which half (even or odd positions) a compaction keeps. A fair coin per compaction keeps the error unbiased; alternating
+        ## does not, because the top levels only compact once or twice. Seeded so the same stream always gives the same answers.
+        self.generator = np.random.default_rng(seed)
+
+    def capacity(self, level):
+        ## Lower levels get geometrically smaller buffers than the top level, which holds k items
+        depth = len(self.compactors) - level - 1
+        return max(2, int(math.ceil(self.k * (2/3)**depth)))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self.count += len(values)
+        self.compress()
+
+    def compress(self):
+        level = 0
+        while level < len(self.compactors):
+            if len(self.compactors[level]) > self.capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append(np.empty(0))
+
+                ## Sort the buffer, promote every other item (doubling its weight) and keep the odd one out, if any, at this level
+                buffer = np.sort(self.compactors[level])
+                num_compacted = len(buffer) - len(buffer) % 2
+                promoted = buffer[:num_compacted][int(self.generator.integers(2))::2]
+                self.compactors[level] = buffer[num_compacted:]
+                self.compactors[level+1] = np.concatenate([self.compactors[level+1], promoted])
+            level += 1
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.empty(0))
+        for level, items in enumerate(other.compactors):
+            self.compactors[level] = np.concatenate([self.compactors[level], items])
+        self.count += other.count
+        self.compress()
+        return self
+
+    def quantile(self, q):
+        ''' Approximate q-th quantile (0 <= q <= 1) of every sample added so far'''
+        items = np.concatenate(self.compactors)
+        if len(items) == 0:
+            return float('nan')
+        weights = np.concatenate([np.full(len(items_at_level), 2**level) for level, items_at_level in enumerate(self.compactors)])
+        order = np.argsort(items, kind='stable')
+        cumulative_weight = np.cumsum(weights[order])
+        index = np.searchsorted(cumulative_weight, q*cumulative_weight[-1], side='left')
+        return float(items[order][min(index, len(items)-1)])
+
+    def percentile(self, p):
+        return self.quantile(p/100)
+
+    def rank_error(self):
+        ''' Normalized rank error that a single quantile stays within with 99% confidence, using the empirical KLL constants
+        (about 1.65% at k=200): quantile(q) is at a rank between q - rank_error() and q + rank_error() of the samples added'''
+        return 2.446/self.k**0.9433
+
+
+#############################################################################
+#############################################################################
+########################### HISTOGRAM CLASS #################################
+#############################################################################
+#############################################################################
+def histogram_edges(hist_size=.25, upper_limit=15, lower_limit=0):
+    ''' Evenly spaced bin edges from lower_limit to upper_limit. The default is the 0.25x-wide bins up to 15x used by montecarlo_histogram'''
+    return lower_limit + hist_size*np.arange(int(round((upper_limit - lower_limit)/hist_size)) + 1)
+
+
+class Histogram:
+    ''' Integer counts of outcomes per bin. Bin i covers [edges[i], edges[i+1]); anything below the first edge is underflow and anything at or above the last edge is overflow.
+    Two histograms with the same edges can be merged, so runs can be combined without keeping their raw outcomes.'''
+
+    def __init__(self, edges=None):
+        self.edges = histogram_edges() if edges is None else np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    @classmethod
+    def from_values(cls, values, edges=None):
+        histogram = cls(edges)
+        histogram.add(values)
+        return histogram
+
+    def add(self, values):
+        ## Single pass: locate every value's bin, then count them all at once
+        bins = np.searchsorted(self.edges, np.asarray(values, dtype=np.float64).ravel(), side='right') - 1
+        counts = np.bincount(bins + 1, minlength=len(self.edges) + 1)
+        self.underflow += int(counts[0])
+        self.counts += counts[1:len(self.edges)]
+        self.overflow += int(counts[len(self.edges):].sum())
+
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Cannot merge histograms with different bin edges')
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self
+
+    def total(self):
+        return int(self.counts.sum()) + self.underflow + self.overflow
+
+    def labels(self):
+        return [f"{float(low)}-{float(high)}" for low, high in zip(self.edges[:-1], self.edges[1:])]
+
+    def to_dict(self):
+        ''' Same layout as the original montecarlo_histogram output ({'0.0-0.25': [count], ...}), with integer counts'''
+        return {label: [int(count)] for label, count in zip(self.labels(), self.counts)}
+
+    def __repr__(self):
+        return str(self.to_dict())
+
+
+#############################################################################
+#############################################################################
+####################### OUTCOME ACCUMULATOR CLASS ###########################
+#############################################################################
+#############################################################################
+class OutcomeAccumulator:
+    ''' Running summary of a stream of scenario outcomes: count, mean, variance, a fixed-bin histogram and a quantile sketch.
+    Accumulators built from different batches (or different processes) can be merged into one.'''
+
+    def __init__(self, k=200, edges=None, seed=0):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0 ## sum of squared differences from the mean
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.histogram = Histogram(edges)
+        self.sketch = QuantileSketch(k, seed)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        batch = OutcomeAccumulator.__new__(OutcomeAccumulator)
+        batch.count = len(values)
+        batch.mean = float(values.mean())
+        batch.m2 = float(((values - batch.mean)**2).sum())
+        self.combine_moments(batch)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        self.histogram.add(values)
+        self.sketch.update(values)
+
+    def combine_moments(self, other):
+        ## Chan et al. parallel update of count, mean and sum of squared differences
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta*other.count/count
+        self.m2 += other.m2 + delta**2*self.count*other.count/count
+        self.count = count
+
+    def merge(self, other):
+        self.combine_moments(other)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.histogram.merge(other.histogram)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.m2/(self.count - 1)
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    def percentile(self, p):
+        return self.sketch.percentile(p)
+
+
+#############################################################################
+#############################################################################
+####################### SIMULATION RESULT CLASS #############################
+#############################################################################
+#############################################################################
+class SimulationResult:
+    ''' Per-scenario outcomes of a finished simulation, computed once. Sorted views, percentiles and histograms are computed on first use and memoized.'''
+
+    def __init__(self, mom, value, invested_capital, alive_value, acquired_value, irr=None):
+        self.outcomes = {
+            'MoM': np.asarray(mom, dtype=np.float64),
+            'Value': np.asarray(value, dtype=np.float64),
+            'Invested': np.asarray(invested_capital, dtype=np.float64),
+            'Alive': np.asarray(alive_value, dtype=np.float64),
+            'Acquired': np.asarray(acquired_value, dtype=np.float64)
+        }
+        if irr is not None:
+            self.outcomes['IRR'] = np.asarray(irr, dtype=np.float64)
+        self.cache = {}
+
+    @classmethod
+    def from_firms(cls, firms, cash_flow_years=None):
+        ''' Outcomes of simulated Firm objects. With cash_flow_years (the date in years of each period's cash flows), every firm's IRR is solved as well.'''
+        mom, value, invested, alive, acquired, cash_flows = [], [], [], [], [], []
+        for firm in firms:
+            detailed = firm.detailed_portfolio_value()
+            mom.append(firm.get_MoM())
+            value.append(firm.concise_portfolio_value())
+            invested.append(firm.get_capital_invested())
+            alive.append(detailed['Alive'])
+            acquired.append(detailed['Acquired'])
+            if cash_flow_years is not None:
+                cash_flows.append(firm.get_cash_flows(len(cash_flow_years) - 1))
+        irr = internal_rate_of_return(np.array(cash_flows).reshape(len(cash_flows), -1), cash_flow_years) if cash_flow_years is not None else None
+        return cls(mom, value, invested, alive, acquired, irr)
+
+    @classmethod
+    def from_scenario_arrays(cls, arrays, cash_flow_years=None):
+        detailed = arrays.detailed_portfolio_value()
+        irr = internal_rate_of_return(arrays.cash_flows(), cash_flow_years) if cash_flow_years is not None else None
+        return cls(arrays.get_MoM(), arrays.concise_portfolio_value(), arrays.get_capital_invested(), detailed['Alive'], detailed['Acquired'], irr)
+
+    def __len__(self):
+        return len(self.outcomes['MoM'])
+
+    @property
+    def mom(self):
+        return self.outcomes['MoM']
+
+    @property
+    def value(self):
+        return self.outcomes['Value']
+
+    @property
+    def invested_capital(self):
+        return self.outcomes['Invested']
+
+    def sorted(self, type='MoM'):
+        key = ('sorted', type)
+        if key not in self.cache:
+            self.cache[key] = np.sort(self.outcomes[type])
+        return self.cache[key]
+
+    def percentile(self, p, type='MoM'):
+        key = ('percentile', type, p)
+        if key not in self.cache:
+            self.cache[key] = float(np.percentile(self.sorted(type), p))
+        return self.cache[key]
+
+    def median(self, type='MoM'):
+        return self.percentile(50, type)
+
+    def mean(self, type='MoM'):
+        key = ('mean', type)
+        if key not in self.cache:
+            self.cache[key] = float(self.outcomes[type].mean())
+        return self.cache[key]
+
+    def summary(self, type='MoM'):
+        ''' Flat dict of headline statistics, e.g. one row of a sweep table'''
+        outcomes = self.outcomes[type]
+        summary = {
+            'Num Simulations': len(self),
+            'Mean ' + type: self.mean(type),
+            'Std ' + type: float(outcomes.std(ddof=1)) if len(self) > 1 else 0.0
+        }
+        for p in [25, 50, 75, 90, 95]:
+            summary[f'P{p} {type}'] = self.percentile(p, type)
+        summary['P(MoM < 1)'] = float((self.mom < 1).mean())
+        summary['Mean Invested'] = self.mean('Invested')
+        return summary
+
+    def histogram(self, edges=None, type='MoM'):
+        edges = histogram_edges() if edges is None else np.asarray(edges, dtype=np.float64)
+        key = ('histogram', type, tuple(edges))
+        if key not in self.cache:
+            self.cache[key] = Histogram.from_values(self.outcomes[type], edges)
+        return self.cache[key]
+
+
+class DistributionResult:
+    ''' Outcome distribution of the exact engine: MoM values and their probabilities, with no individual scenarios.
+    Offers the same percentile / mean / summary / histogram interface as SimulationResult; histograms hold the expected counts for num_scenarios scenarios.'''
+
+    def __init__(self, mom, probability, num_scenarios, mean_invested, tail_probability=0.0):
+        order = np.argsort(mom, kind='stable')
+        self.support = np.asarray(mom, dtype=np.float64)[order]
+        self.probability = np.asarray(probability, dtype=np.float64)[order]
+        self.cumulative_probability = np.cumsum(self.probability)
+        self.num_scenarios = num_scenarios
+        self.mean_invested = float(mean_invested)
+
+        ## Probability that the portfolio value ran past the top of the value grid (counted at the top of the grid)
+        self.tail_probability = float(tail_probability)
+
+    def __len__(self):
+        return self.num_scenarios
+
+    def percentile(self, p, type='MoM'):
+        ## Smallest outcome whose cumulative probability reaches p%, allowing for float error in the cumulative sum
+        index = np.searchsorted(self.cumulative_probability, p/100 - 1e-12)
+        return float(self.support[min(index, len(self.support) - 1)])
+
+    def median(self, type='MoM'):
+        return self.percentile(50, type)
+
+    def mean(self, type='MoM'):
+        if type == 'Invested':
+            return self.mean_invested
+        return float(np.dot(self.support, self.probability))
+
+    def std(self):
+        return math.sqrt(max(0.0, float(np.dot(self.probability, (self.support - self.mean())**2))))
+
+    def summary(self, type='MoM'):
+        summary = {
+            'Num Simulations': self.num_scenarios,
+            'Mean MoM': self.mean(),
+            'Std MoM': self.std()
+        }
+        for p in [25, 50, 75, 90, 95]:
+            summary[f'P{p} MoM'] = self.percentile(p)
+        summary['P(MoM < 1)'] = float(self.probability[self.support < 1].sum())
+        summary['Mean Invested'] = self.mean_invested
+        return summary
+
+    def histogram(self, edges=None, type='MoM'):
+        histogram = Histogram(edges)
+        bins = np.searchsorted(histogram.edges, self.support, side='right') - 1
+        expected = np.rint(np.bincount(bins + 1, weights=self.probability, minlength=len(histogram.edges) + 1)*self.num_scenarios).astype(np.int64)
+        histogram.underflow = int(expected[0])
+        histogram.counts += expected[1:len(histogram.edges)]
+        histogram.overflow = int(expected[len(histogram.edges):].sum())
+        return histogram
+
+
+def paired_difference(baseline, candidate, type='MoM'):
+    ''' Compare two SimulationResults scenario by scenario. With common random numbers, scenario i of both runs saw the same company fate draws,
+    so the paired difference has a much smaller standard error than comparing two independent runs.'''
+    num_scenarios = min(len(baseline), len(candidate))
+    baseline_outcomes = baseline.outcomes[type][:num_scenarios]
+    candidate_outcomes = candidate.outcomes[type][:num_scenarios]
+    difference = candidate_outcomes - baseline_outcomes
+
+    paired_standard_error = difference.std(ddof=1)/math.sqrt(num_scenarios)
+    independent_standard_error = math.sqrt((baseline_outcomes.var(ddof=1) + candidate_outcomes.var(ddof=1))/num_scenarios)
+    return {
+        'Mean difference': float(difference.mean()),
+        'Standard error': float(paired_standard_error),
+        'Independent standard error': float(independent_standard_error),
+        'Variance reduction': float((independent_standard_error/paired_standard_error)**2) if paired_standard_error > 0 else float('inf')
+    }
+
+
+def quantile_confidence_interval(sorted_outcomes, p, confidence=0.95):
+    ''' Distribution-free confidence interval for the p-th percentile of sorted_outcomes: the number of samples below the true
+    percentile is Binomial(n, p/100), so the interval runs between the order statistics at n*p/100 -/+ z standard deviations'''
+    num_outcomes = len(sorted_outcomes)
+    q = p/100
+    z = NormalDist().inv_cdf(0.5 + confidence/2)
+    spread = z*math.sqrt(num_outcomes*q*(1 - q))
+    lower = int(max(0, math.floor(num_outcomes*q - spread)))
+    upper = int(min(num_outcomes - 1, math.ceil(num_outcomes*q + spread)))
+    return float(sorted_outcomes[lower]), float(sorted_outcomes[upper])
+
+
+def control_variate_estimate(outcomes, control, control_mean, percentiles=(25, 50, 75, 90, 95)):
+    ''' Control-variate estimates of the mean and percentiles of outcomes, given a per-scenario control whose true mean is known exactly.
+    The mean is corrected by beta*(control mean - sample control mean) with the regression beta. Percentiles come from the control-variate
+    weighted empirical distribution (weights 1/n - (c_i - mean c)*(mean c - control_mean)/sum (c_j - mean c)^2), which matches the known control mean.'''
+    outcomes = np.asarray(outcomes, dtype=np.float64)
+    control = np.asarray(control, dtype=np.float64)
+    num_outcomes = len(outcomes)
+
+    centered_control = control - control.mean()
+    control_sum_of_squares = float(np.dot(centered_control, centered_control))
+    beta = float(np.dot(centered_control, outcomes - outcomes.mean())/control_sum_of_squares) if control_sum_of_squares > 0 else 0.0
+    correlation = float(np.corrcoef(outcomes, control)[0, 1]) if control_sum_of_squares > 0 and outcomes.std() > 0 else 0.0
+
+    ## Weighted empirical distribution: cumulative weight of the sorted outcomes, capped to [0, 1] since control-variate weights can be negative
+    weights = np.full(num_outcomes, 1/num_outcomes)
+    if control_sum_of_squares > 0:
+        weights -= centered_control*(control.mean() - control_mean)/control_sum_of_squares
+    order = np.argsort(outcomes, kind='stable')
+    cumulative_weight = np.maximum.accumulate(np.clip(np.cumsum(weights[order]), 0, 1))
+
+    plain_standard_error = float(outcomes.std(ddof=1)/math.sqrt(num_outcomes))
+    return {
+        'Mean': float(outcomes.mean() - beta*(control.mean() - control_mean)),
+        'Mean (plain)': float(outcomes.mean()),
+        'Standard error': plain_standard_error*math.sqrt(max(0.0, 1 - correlation**2)),
+        'Standard error (plain)': plain_standard_error,
+        'Control mean': float(control.mean()),
+        'Control expected value': float(control_mean),
+        'Correlation': correlation,
+        'Variance reduction': 1/(1 - correlation**2) if abs(correlation) < 1 else float('inf'),
+        'Percentiles': {p: float(outcomes[order][min(np.searchsorted(cumulative_weight, p/100), num_outcomes - 1)]) for p in percentiles},
+        'Percentiles (plain)': {p: float(np.percentile(outcomes, p)) for p in percentiles}
+    }
+
+
+def lattice_distribution(points, probability, bin_widths, shape):
+    ''' Spread a discrete distribution over points (one column per axis) onto a grid of the given shape and bin widths. Each point's probability
+    is split linearly between its neighbouring grid nodes on every axis, which keeps the mean exact; points past the end of an axis go to its last node.'''
+    points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+    grid = np.zeros(shape)
+    corners = []
+    for axis, (width, size) in enumerate(zip(bin_widths, shape)):
+        position = np.clip(points[:, axis]/width if width > 0 else np.zeros(len(points)), 0, size - 1)
+        low = np.minimum(np.floor(position).astype(np.int64), size - 1)
+        high = np.minimum(low + 1, size - 1)
+        upper_weight = position - low
+        corners.append(((low, 1 - upper_weight), (high, upper_weight)))
+    for corner in itertools.product(*corners):
+        index = tuple(node for node, weight in corner)
+        weight = np.prod([weight for node, weight in corner], axis=0)
+        np.add.at(grid, index, probability*weight)
+    return grid
+
+
+def common_step(amounts, max_denominator=1000):
+    ''' Largest step that every amount is a whole multiple of (0.3 for 0.6 and 1.5), or None when the amounts are not all close to fractions with
+    a denominator up to max_denominator'''
+    step = Fraction(0)
+    for amount in np.unique(np.asarray(amounts, dtype=np.float64)):
+        fraction = Fraction(float(amount)).limit_denominator(max_denominator)
+        if abs(float(fraction) - amount) > 1e-9*max(1, abs(amount)):
+            return None
+        step = Fraction(math.gcd(step.numerator*fraction.denominator, fraction.numerator*step.denominator), step.denominator*fraction.denominator)
+    return float(step) if step > 0 else None
+
+
+def internal_rate_of_return(cash_flows, years, iterations=100, tolerance=1e-10):
+    ''' Annual IRR of every row of cash_flows (scenarios x dates) at once, where years holds the date of each column.
+    Solves for the log growth rate z, where NPV(z) = sum of cash flow * exp(-z * years) is zero, with Newton steps kept inside a bisection bracket
+    that starts at [-10, 10] (-99.995% to 2.2 million % a year). A scenario that never gets any money back returns -100%.'''
+    cash_flows = np.asarray(cash_flows, dtype=np.float64)
+    years = np.asarray(years, dtype=np.float64)
+    num_scenarios = len(cash_flows)
+    lower = np.full(num_scenarios, -10.0)
+    upper = np.full(num_scenarios, 10.0)
+
+    ## Start from the rate that turns the money put in into the money taken out over the whole period
+    paid_in = -np.minimum(cash_flows, 0).sum(axis=1)
+    paid_out = np.maximum(cash_flows, 0).sum(axis=1)
+    total_loss = paid_out <= 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_growth = np.clip(np.log(paid_out/paid_in)/years[-1], lower, upper)
+    log_growth[~np.isfinite(log_growth)] = 0
+
+    ## Only rows that have not converged yet are iterated on
+    active = np.flatnonzero(~total_loss)
+    for iteration in range(iterations):
+        if len(active) == 0:
+            break
+        discounted = cash_flows[active]*np.exp(-np.outer(log_growth[active], years))
+        npv = discounted.sum(axis=1)
+        slope = -(discounted*years).sum(axis=1)
+
+        ## A positive NPV means the rate is too low
+        lower[active] = np.where(npv > 0, log_growth[active], lower[active])
+        upper[active] = np.where(npv > 0, upper[active], log_growth[active])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = log_growth[active] - npv/slope
+        step = np.where((newton > lower[active]) & (newton < upper[active]), newton, (lower[active] + upper[active])/2)
+        moving = np.abs(step - log_growth[active]) >= tolerance
+        log_growth[active] = step
+        active = active[moving]
+
+    irr = np.expm1(log_growth)
+    irr[total_loss] = -1.0
+    return irr
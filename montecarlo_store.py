@@ -0,0 +1,112 @@
+import os
+import json
+import numpy as np
+from montecarlo_statistics import OutcomeAccumulator, histogram_edges
+
+
+#############################################################################
+#############################################################################
+########################### RESULT STORE CLASS ##############################
+#############################################################################
+#############################################################################
+class ResultStore:
+    ''' Per-scenario outcomes of a simulation kept on disk as one .npy file per column in a directory, plus a metadata.json.
+    Columns are preallocated and filled chunk by chunk while the simulation runs, and reopened later as read-only memory maps,
+    so a run of any size can be queried without re-simulating it or loading it into RAM.
+
+    Optionally the store also keeps each primary portfolio company's final stage, state, firm value and invested capital
+    (scenario x company), with every company's entry stage, so outcomes can be sliced by entry stage.'''
+
+    outcome_columns = ('MoM', 'Value', 'Invested', 'Alive', 'Acquired', 'IRR')
+    company_columns = {'stage': np.int8, 'state': np.int8, 'firm_value': np.float32, 'invested': np.float32}
+
+    def __init__(self, path, metadata, columns):
+        self.path = path
+        self.metadata = metadata
+        self.columns = columns
+
+    @classmethod
+    def create(cls, path, num_scenarios, stages, entry_stage=None, metadata=None):
+        ''' Preallocate a store for num_scenarios scenarios. Pass entry_stage (the stage id of each primary portfolio company) to keep per-company final states.'''
+        os.makedirs(path, exist_ok=True)
+        columns = {name: np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+', dtype=np.float64, shape=(num_scenarios,))
+                   for name in cls.outcome_columns}
+        if entry_stage is not None:
+            np.save(os.path.join(path, 'entry_stage.npy'), np.asarray(entry_stage, dtype=np.int8))
+            for name, dtype in cls.company_columns.items():
+                columns[name] = np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+', dtype=dtype, shape=(num_scenarios, len(entry_stage)))
+
+        metadata = {**(metadata or {}), 'num_scenarios': num_scenarios, 'stages': list(stages), 'columns': list(columns), 'num_written': 0, 'complete': False}
+        store = cls(path, metadata, columns)
+        store.write_metadata()
+        return store
+
+    @classmethod
+    def open(cls, path):
+        ''' Reopen a store with every column memory-mapped read-only'''
+        with open(os.path.join(path, 'metadata.json')) as metadata_file:
+            metadata = json.load(metadata_file)
+        columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in metadata['columns']}
+        return cls(path, metadata, columns)
+
+    def write_metadata(self):
+        with open(os.path.join(self.path, 'metadata.json'), 'w') as metadata_file:
+            json.dump(self.metadata, metadata_file, indent=2, default=str)
+
+    def write(self, start, outcomes, arrays=None):
+        ''' Write a chunk of scenarios starting at scenario start: outcomes is a SimulationResult's outcomes dict, arrays the chunk's ScenarioArrays (for per-company states)'''
+        size = len(outcomes['MoM'])
+        for name in self.outcome_columns:
+            self.columns[name][start:start + size] = outcomes[name]
+        if arrays is not None and 'stage' in self.columns:
+            self.columns['stage'][start:start + size] = arrays.stage
+            self.columns['state'][start:start + size] = arrays.state
+            self.columns['firm_value'][start:start + size] = arrays.valuation*arrays.firm_ownership
+            self.columns['invested'][start:start + size] = arrays.firm_invested_capital
+        self.metadata['num_written'] = max(self.metadata['num_written'], start + size)
+
+    def close(self):
+        for column in self.columns.values():
+            column.flush()
+        self.metadata['complete'] = self.metadata['num_written'] == self.metadata['num_scenarios']
+        self.write_metadata()
+
+    def __len__(self):
+        return self.metadata['num_written']
+
+    def __getitem__(self, name):
+        return self.columns[name][:len(self)]
+
+    def entry_stage(self):
+        return np.load(os.path.join(self.path, 'entry_stage.npy'))
+
+    def chunks(self, chunk_size=1000000):
+        for start in range(0, len(self), chunk_size):
+            yield slice(start, min(start + chunk_size, len(self)))
+
+    def accumulate(self, type='MoM', chunk_size=1000000, edges=None):
+        ''' Stream a column through an OutcomeAccumulator one chunk at a time: exact count / mean / std / histogram, sketched percentiles'''
+        if edges is None and type == 'IRR':
+            edges = histogram_edges(.05, 1, -1)
+        accumulator = OutcomeAccumulator(edges=edges)
+        for chunk in self.chunks(chunk_size):
+            accumulator.update(self.columns[type][chunk])
+        return accumulator
+
+    def percentile(self, p, type='MoM', chunk_size=1000000):
+        return self.accumulate(type, chunk_size).percentile(p)
+
+    def entry_stage_outcomes(self, stage, chunk_size=1000000):
+        ''' Per-scenario final firm value and invested capital of the companies that entered at stage (a stage name or id). Needs per-company states.'''
+        if 'stage' not in self.columns:
+            raise ValueError('This store was written without per-company states')
+        stage_id = self.metadata['stages'].index(stage) if isinstance(stage, str) else stage
+        companies = np.flatnonzero(self.entry_stage() == stage_id)
+        value, invested = np.empty(len(self)), np.empty(len(self))
+        for chunk in self.chunks(chunk_size):
+            value[chunk] = self.columns['firm_value'][chunk][:, companies].sum(axis=1, dtype=np.float64)
+            invested[chunk] = self.columns['invested'][chunk][:, companies].sum(axis=1, dtype=np.float64)
+        return {'Value': value, 'Invested': invested}
+
+    def __repr__(self):
+        return f"ResultStore({self.path!r}, {len(self)} of {self.metadata['num_scenarios']} scenarios, columns {self.metadata['columns']})"
@@ -0,0 +1,40 @@
+import pytest
+import numpy as np
+from montecarlo_simulation import Montecarlo, CounterDraws, PHILOX_KNOWN_ANSWERS, philox4x32, build_firm_attributes_for_simulation, stages, stage_probs, stage_valuations, stage_dilution
+
+
+def test_philox_known_answers():
+    for counter, key, expected in PHILOX_KNOWN_ANSWERS:
+        assert tuple(int(word) for word in philox4x32(counter, key)) == expected
+
+
+def test_philox_broadcasts_counter_arrays():
+    ## A grid of counters hashes the same as each counter on its own
+    counters = np.arange(6, dtype=np.uint64)
+    words = philox4x32((counters, 0, 7, 0), (1, 2))
+    for index, counter in enumerate(counters):
+        assert tuple(int(word[index]) for word in words) == tuple(int(word) for word in philox4x32((counter, 0, 7, 0), (1, 2)))
+
+
+def test_counter_draws_are_uniform():
+    uniforms = CounterDraws((3, 4)).uniforms('decision', 0, (20000, 10))
+    assert uniforms.min() >= 0 and uniforms.max() < 1
+    assert abs(uniforms.mean() - .5) < .005
+
+
+def test_replay_scenario_matches_run():
+    firm_attributes = build_firm_attributes_for_simulation(.3, 1.5, .7, 4, 180, 20, 200, 'Series A')
+    montecarlo = Montecarlo(200, stages, stage_probs, stage_valuations, stage_dilution, firm_attributes, engine='vectorized', seed=11, sampling='counter')
+    montecarlo.initialize_scenarios()
+    montecarlo.simulate()
+    for index in (0, 57, 199):
+        arrays, trajectories = montecarlo.replay_scenario(index)
+        assert arrays.get_MoM()[0] == montecarlo.result.mom[index]
+
+
+def test_generator_seed_gives_one_seed_sequence():
+    firm_attributes = build_firm_attributes_for_simulation(.3, 1.5, .7, 4, 180, 20, 200, 'Series A')
+    montecarlo = Montecarlo(10, stages, stage_probs, stage_valuations, stage_dilution, firm_attributes, engine='vectorized', seed=np.random.default_rng(2))
+    assert montecarlo.seed_sequence().entropy == montecarlo.seed_sequence().entropy
+    with pytest.raises(ValueError):
+        Montecarlo(10, stages, stage_probs, stage_valuations, stage_dilution, firm_attributes, engine='vectorized', seed=np.random.default_rng(2), common_random_numbers=True)
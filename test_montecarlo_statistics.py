@@ -0,0 +1,47 @@
+import numpy as np
+from montecarlo_statistics import QuantileSketch, OutcomeAccumulator
+
+
+def sketch_rank_errors(sketch, values, quantiles):
+    ## Where each sketched quantile actually falls among the samples, minus where it should
+    ordered = np.sort(values)
+    return [np.searchsorted(ordered, sketch.quantile(q), side='right')/len(values) - q for q in quantiles]
+
+
+def test_quantile_sketch_within_kll_bound():
+    quantiles = (.05, .25, .5, .75, .95)
+    for seed in range(4):
+        values = np.random.default_rng(seed).random(300000)
+        sketch = QuantileSketch()
+        for batch in values.reshape(-1, 1000):
+            sketch.update(batch)
+        assert max(abs(error) for error in sketch_rank_errors(sketch, values, quantiles)) <= sketch.rank_error()
+
+
+def test_quantile_sketch_unbiased():
+    ## Averaged over streams, the sketched P5 and P95 should sit on the true ones rather than consistently below them
+    errors = []
+    for seed in range(20):
+        values = np.random.default_rng(seed).random(100000)
+        sketch = QuantileSketch(seed=seed)
+        for batch in values.reshape(-1, 1000):
+            sketch.update(batch)
+        errors.append(sketch_rank_errors(sketch, values, (.05, .95)))
+    assert np.all(np.abs(np.mean(errors, axis=0)) < .002)
+
+
+def test_merged_accumulators_match_percentiles():
+    values = np.random.default_rng(5).lognormal(0, 1, 200000)
+    accumulators = [OutcomeAccumulator(seed=shard) for shard in range(4)]
+    for shard, chunk in enumerate(np.split(values, 4)):
+        for batch in chunk.reshape(-1, 1000):
+            accumulators[shard].update(batch)
+    merged = accumulators[0]
+    for accumulator in accumulators[1:]:
+        merged.merge(accumulator)
+    assert merged.count == len(values)
+    assert np.isclose(merged.mean, values.mean())
+    ordered = np.sort(values)
+    for p in (5, 50, 95):
+        rank = np.searchsorted(ordered, merged.percentile(p), side='right')/len(values)
+        assert abs(rank - p/100) <= merged.sketch.rank_error()